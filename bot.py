@@ -9,27 +9,111 @@
 """
 
 import os
+import sys
+import csv
+import json
+import math
+import re
+import heapq
+import hashlib
 import random
+import signal
+import socket
+import argparse
+import tempfile
+import asyncio
 import logging
-from datetime import datetime, time, timedelta
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import Counter, OrderedDict, defaultdict, deque
+from datetime import datetime, time, timedelta, timezone
+from functools import lru_cache
+from itertools import count, groupby
+from time import monotonic
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     ConversationHandler,
     CallbackQueryHandler,
     filters,
     ContextTypes,
+    PersistenceInput,
 )
 import sqlite3
+import numpy as np
 
 # ── Configurazione ──────────────────────────────────────────────
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "IL_TUO_TOKEN_QUI")
+# Server delle Bot API: cambiarlo solo per test contro un finto endpoint locale
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
+
+# Ricezione aggiornamenti: "polling" (default), "webhook" oppure "worker" (solo job, niente update).
+# I processi "worker" si dividono gli utenti tramite i lease nel database: servono solo se
+# tutti i processi aprono lo stesso file SQLite (volume condiviso, non dyno separati).
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # URL pubblico, es. https://diet-bot.example.com
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+# Update elaborati in parallelo (sempre in ordine per lo stesso utente)
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "32"))
 
 # Usa /data se esiste (volume Railway), altrimenti cartella locale
 DATA_DIR = "/data" if os.path.isdir("/data") else "."
 DB_PATH = os.path.join(DATA_DIR, "diet_bot.db")
+# Connessioni SQLite tenute aperte, una per thread del pool
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "4"))
+DB_TIMEOUT = 30
+DB_CACHE_KB = int(os.environ.get("DB_CACHE_KB", "16384"))
+# Le scritture in coda vengono raggruppate in una transazione ogni pochi millisecondi
+DB_WRITE_BATCH_DELAY = 0.005
+DB_WRITE_BATCH_MAX = 500
+# Cache in memoria dei piani settimanali (numero di utenti, secondi di validita')
+PLAN_CACHE_SIZE = int(os.environ.get("PLAN_CACHE_SIZE", "1000"))
+PLAN_CACHE_TTL = int(os.environ.get("PLAN_CACHE_TTL", "600"))
+# Analisi dei progressi: risultati in cache fino alla rilevazione successiva, andamento sugli ultimi giorni
+ANALYTICS_CACHE_SIZE = int(os.environ.get("ANALYTICS_CACHE_SIZE", "1000"))
+ANALYTICS_CACHE_TTL = 24 * 3600
+ANALYTICS_TREND_DAYS = 90
+# Andamento sotto questa soglia (unita'/settimana) = stabile; previsioni oltre questo orizzonte (giorni) scartate
+ANALYTICS_FLAT_WEEKLY = 0.01
+ANALYTICS_MAX_PROJECTION_DAYS = 730
+# Grafici dei progressi: PNG su disco (uno per utente) e processi dedicati al rendering
+CHART_DIR = os.path.join(DATA_DIR, "charts")
+CHART_WORKERS = int(os.environ.get("CHART_WORKERS", "1"))
+# Invii in massa: limite globale di Telegram (~30 msg/s), invii in parallelo, tentativi
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "16"))
+BROADCAST_MAX_RETRIES = 3
+BROADCAST_PROGRESS_EVERY = 500
+# Messaggi allo stesso utente entro questa finestra (secondi) partono come uno solo
+OUTBOX_COALESCE_SECONDS = float(os.environ.get("OUTBOX_COALESCE_SECONDS", "2"))
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+# Pasti per pagina nelle tastiere di scelta (copia, modifica, elimina)
+PLAN_PAGE_SIZE = 8
+# Ogni quanto salvare su database i dati delle conversazioni modificati (secondi)
+PERSISTENCE_INTERVAL = float(os.environ.get("PERSISTENCE_INTERVAL", "30"))
+# Conversazioni senza risposta per questo tempo vengono chiuse (secondi)
+CONVERSATION_TIMEOUT = int(os.environ.get("CONVERSATION_TIMEOUT", "900"))
+# user_data in memoria: utenti inattivi da tanto o oltre il limite tornano solo su database
+USER_DATA_MAX_USERS = int(os.environ.get("USER_DATA_MAX_USERS", "5000"))
+USER_DATA_IDLE_SECONDS = int(os.environ.get("USER_DATA_IDLE_SECONDS", "1800"))
+USER_DATA_EVICT_INTERVAL = 300
+# Esporta/importa: righe lette o scritte per blocco e dimensione massima del file da importare
+EXPORT_BATCH_ROWS = 500
+IMPORT_BATCH_ROWS = 500
+IMPORT_MAX_BYTES = 5 * 1024 * 1024
+# Ogni quanto scrivere nel log le metriche interne (secondi)
+METRICS_LOG_INTERVAL = int(os.environ.get("METRICS_LOG_INTERVAL", "900"))
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -44,7 +128,47 @@ logger = logging.getLogger(__name__)
     PROGRESS_WEIGHT, PROGRESS_WAIST, PROGRESS_HIPS, PROGRESS_CHEST,
     SETTINGS_DAY, SETTINGS_GROCERY_TIME,
     EDIT_SELECT, EDIT_FIELD, EDIT_VALUE,
-) = range(15)
+    IMPORT_FILE, SETTINGS_TIMEZONE,
+) = range(17)
+
+# Chiavi di context.user_data usate da ogni flusso, rimosse quando il flusso finisce
+FLOW_KEYS = {
+    "meal": ("meal_days", "meal_days_label", "meal_name", "meal_time", "meal_recipe", "meal_reminder_minutes"),
+    "progress": ("progress_weight", "progress_waist", "progress_hips", "progress_chest"),
+    "settings": ("settings_checkin_day", "settings_grocery_time"),
+    "edit": ("edit_meal_id", "edit_field"),
+    "import": (),
+}
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+# Ogni quanto girano i job dei reminder pasti e spesa (secondi)
+REMINDER_TICK_SECONDS = int(os.environ.get("REMINDER_TICK_SECONDS", "60"))
+GROCERY_TICK_SECONDS = int(os.environ.get("GROCERY_TICK_SECONDS", "300"))
+# /spesa: giorni coperti se non indicati e massimo consentito
+GROCERY_DEFAULT_DAYS = 7
+GROCERY_MAX_DAYS = 28
+# Fuso orario degli utenti che non ne hanno scelto uno; proposte nelle impostazioni
+DEFAULT_TIMEZONE = os.environ.get("DEFAULT_TIMEZONE", "Europe/Rome")
+TIMEZONE_CHOICES = ["Europe/Rome", "Europe/London", "Europe/Madrid", "America/New_York", "America/Sao_Paulo", "Asia/Dubai"]
+# Ora locale di check-in settimanale e messaggi motivazionali (minuti dalla mezzanotte)
+CHECKIN_MINUTE = 9 * 60
+MOTIVATION_MINUTES = (10 * 60, 15 * 60)
+# Reminder persi (riavvio, job in ritardo) vengono recuperati se non piu' vecchi di cosi' (minuti)
+REMINDER_GRACE_MINUTES = int(os.environ.get("REMINDER_GRACE_MINUTES", "30"))
+# Giorni di storico conservati nel registro dei reminder inviati
+SENT_REMINDERS_KEEP_DAYS = 7
+# Job divisi tra piu' processi: ogni worker possiede alcuni shard (user_id % SHARD_COUNT)
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", "1"))
+WORKER_ID = os.environ.get("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+SHARD_LEASE_SECONDS = 30
+SHARD_HEARTBEAT_SECONDS = 10
+
+# Priorita' dei messaggi in uscita: numero piu' basso = inviato prima
+PRIORITY_MEAL, PRIORITY_GROCERY, PRIORITY_CHECKIN, PRIORITY_MOTIVATION = range(4)
+
+# Misure registrate con /progresso, nell'ordine delle colonne della tabella progress
+PROGRESS_METRICS = ("weight", "waist", "hips", "chest")
 
 GIORNI = ["Lunedi", "Martedi", "Mercoledi", "Giovedi", "Venerdi", "Sabato", "Domenica"]
 GIORNI_SHORT = ["Lun", "Mar", "Mer", "Gio", "Ven", "Sab", "Dom"]
@@ -69,9 +193,21 @@ FRASI_MOTIVAZIONALI = [
 
 
 # ── Database ────────────────────────────────────────────────────
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+# Espressione SQL che converte una colonna 'HH:MM' in minuti dalla mezzanotte
+_SQL_MINUTE = (
+    "(CAST(substr({col}, 1, instr({col}, ':') - 1) AS INTEGER) * 60"
+    " + CAST(substr({col}, instr({col}, ':') + 1) AS INTEGER))"
+)
+
+
+def _add_column(c, table, column, decl):
+    """ALTER TABLE ... ADD COLUMN solo se la colonna non esiste gia'."""
+    c.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in c.fetchall()}:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _migration_base_tables(c):
     c.execute("""
         CREATE TABLE IF NOT EXISTS meals (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -102,22 +238,1632 @@ def init_db():
             grocery_reminder_time TEXT DEFAULT '20:00'
         )
     """)
-    # Migrazione: aggiungi colonna grocery_reminder_time se non esiste
-    try:
-        c.execute("ALTER TABLE user_settings ADD COLUMN grocery_reminder_time TEXT DEFAULT '20:00'")
-    except sqlite3.OperationalError:
+    # Database creati dalle prime versioni del bot
+    _add_column(c, "user_settings", "grocery_reminder_time", "TEXT DEFAULT '20:00'")
+    _add_column(c, "meals", "reminder_minutes_before", "INTEGER DEFAULT 120")
+
+
+def _migration_minute_columns(c):
+    # Orari in minuti dalla mezzanotte, per query a intervallo sugli indici
+    _add_column(c, "meals", "meal_minute", "INTEGER")
+    _add_column(c, "meals", "reminder_minute", "INTEGER")
+    _add_column(c, "user_settings", "grocery_minute", "INTEGER")
+    c.execute(f"UPDATE meals SET meal_minute = {_SQL_MINUTE.format(col='meal_time')} WHERE meal_minute IS NULL")
+    c.execute(
+        "UPDATE meals SET reminder_minute = CASE WHEN reminder_minutes_before = -1 THEN 480 "
+        "ELSE meal_minute - reminder_minutes_before END WHERE reminder_minute IS NULL"
+    )
+    c.execute(
+        f"UPDATE user_settings SET grocery_minute = {_SQL_MINUTE.format(col='grocery_reminder_time')} "
+        "WHERE grocery_minute IS NULL AND grocery_reminder_time IS NOT NULL"
+    )
+    # idx_meals_day_reminder serve anche le ricerche per solo day_of_week
+    c.execute("CREATE INDEX IF NOT EXISTS idx_meals_day_reminder ON meals (day_of_week, reminder_minute)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_user_settings_grocery ON user_settings (grocery_minute)")
+
+
+def _migration_user_indexes(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_meals_user_day_time ON meals (user_id, day_of_week, meal_time)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_progress_user_date ON progress (user_id, date, id)")
+
+
+def _migration_sent_reminders(c):
+    # Registro dei reminder inviati: kind 'meal' -> ref_id = id pasto, 'grocery' -> ref_id = user_id
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS sent_reminders (
+            kind TEXT NOT NULL,
+            ref_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            sent_at TEXT NOT NULL,
+            PRIMARY KEY (kind, ref_id, date)
+        ) WITHOUT ROWID
+    """)
+
+
+def _migration_shards(c):
+    # Lease degli shard: chi li possiede e fino a quando (timestamp unix)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS shard_leases (
+            shard INTEGER PRIMARY KEY,
+            owner TEXT,
+            expires_at REAL NOT NULL DEFAULT 0
+        )
+    """)
+    # Worker vivi, anche quelli che non possiedono ancora nessuno shard
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS workers (
+            worker_id TEXT PRIMARY KEY,
+            expires_at REAL NOT NULL
+        )
+    """)
+    # Modifiche ai pasti, lette dai worker per aggiornare la propria timing wheel
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS schedule_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            meal_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            changed_at REAL NOT NULL
+        )
+    """)
+
+
+def _migration_persistence(c):
+    # Stato delle conversazioni, per riprenderle dopo un riavvio (valori in JSON)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID
+    """)
+
+
+def recipe_hash(meal_name, recipe):
+    """Impronta del contenuto di una ricetta, per riconoscere i duplicati dello stesso utente."""
+    return hashlib.blake2b(f"{meal_name}\0{recipe}".encode(), digest_size=16).digest()
+
+
+def _migration_recipes(c):
+    # Nome e ricetta stanno una volta sola per utente; i pasti li referenziano per id
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS recipes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            hash BLOB NOT NULL,
+            meal_name TEXT NOT NULL,
+            recipe TEXT NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (user_id, hash)
+        )
+    """)
+    _add_column(c, "meals", "recipe_id", "INTEGER REFERENCES recipes (id)")
+    c.connection.create_function("recipe_hash", 2, recipe_hash, deterministic=True)
+    c.execute("""
+        INSERT INTO recipes (user_id, hash, meal_name, recipe, refcount)
+        SELECT user_id, recipe_hash(meal_name, recipe), meal_name, recipe, COUNT(*)
+        FROM meals GROUP BY user_id, meal_name, recipe
+    """)
+    c.execute("""
+        UPDATE meals SET recipe_id = (
+            SELECT r.id FROM recipes r
+            WHERE r.user_id = meals.user_id AND r.hash = recipe_hash(meals.meal_name, meals.recipe)
+        )
+    """)
+    c.execute("ALTER TABLE meals DROP COLUMN meal_name")
+    c.execute("ALTER TABLE meals DROP COLUMN recipe")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_meals_recipe ON meals (recipe_id)")
+
+
+# Aggiorna il riepilogo di una misura con una nuova rilevazione (user_id, metric, valore, data).
+# In un UPDATE di SQLite tutte le espressioni vedono i valori precedenti della riga.
+_SQL_PROGRESS_SUMMARY = """
+    INSERT INTO progress_summary (user_id, metric, last_value, last_date, min_value, max_value,
+                                  count, first_value, first_date, total)
+    VALUES (?1, ?2, ?3, ?4, ?3, ?3, 1, ?3, ?4, ?3)
+    ON CONFLICT (user_id, metric) DO UPDATE SET
+        prev_value = CASE WHEN excluded.last_date >= last_date THEN last_value
+                          WHEN prev_date IS NULL OR excluded.last_date >= prev_date THEN excluded.last_value
+                          ELSE prev_value END,
+        prev_date = CASE WHEN excluded.last_date >= last_date THEN last_date
+                         WHEN prev_date IS NULL OR excluded.last_date >= prev_date THEN excluded.last_date
+                         ELSE prev_date END,
+        last_value = CASE WHEN excluded.last_date >= last_date THEN excluded.last_value ELSE last_value END,
+        last_date = MAX(last_date, excluded.last_date),
+        min_value = MIN(min_value, excluded.min_value),
+        max_value = MAX(max_value, excluded.max_value),
+        count = count + 1,
+        first_value = CASE WHEN excluded.first_date < first_date THEN excluded.first_value ELSE first_value END,
+        first_date = MIN(first_date, excluded.first_date),
+        total = total + excluded.total
+"""
+
+
+def _progress_summary_params(rows):
+    """Parametri per _SQL_PROGRESS_SUMMARY da righe (user_id, date, weight, waist, hips, chest)."""
+    for user_id, date, *values in rows:
+        for metric, value in zip(PROGRESS_METRICS, values):
+            if value is not None:
+                yield user_id, metric, value, date
+
+
+def _migration_progress_summary(c):
+    # Riepilogo per utente e misura: ultima e penultima rilevazione, minimo, massimo, prima, somma
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS progress_summary (
+            user_id INTEGER NOT NULL,
+            metric TEXT NOT NULL,
+            last_value REAL NOT NULL,
+            last_date TEXT NOT NULL,
+            prev_value REAL,
+            prev_date TEXT,
+            min_value REAL NOT NULL,
+            max_value REAL NOT NULL,
+            count INTEGER NOT NULL,
+            first_value REAL NOT NULL,
+            first_date TEXT NOT NULL,
+            total REAL NOT NULL,
+            PRIMARY KEY (user_id, metric)
+        ) WITHOUT ROWID
+    """)
+    c.execute("DELETE FROM progress_summary")
+    c.execute("SELECT user_id, date, weight, waist, hips, chest FROM progress ORDER BY user_id, date, id")
+    c.executemany(_SQL_PROGRESS_SUMMARY, list(_progress_summary_params(c.fetchall())))
+
+
+def _migration_progress_charts(c):
+    # file_id di Telegram dell'ultimo grafico inviato, valido finche' non arriva una nuova rilevazione
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS progress_charts (
+            user_id INTEGER PRIMARY KEY,
+            progress_id INTEGER NOT NULL,
+            file_id TEXT NOT NULL
+        )
+    """)
+
+
+def _migration_recipe_ingredients(c):
+    # Ingredienti estratti da una ricetta, in JSON, calcolati una volta per contenuto (recipes.hash)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS recipe_ingredients (
+            hash BLOB PRIMARY KEY,
+            ingredients TEXT NOT NULL
+        ) WITHOUT ROWID
+    """)
+
+
+def _migration_timezones(c):
+    # Fuso orario IANA dell'utente (NULL = DEFAULT_TIMEZONE)
+    _add_column(c, "user_settings", "timezone", "TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_user_settings_timezone ON user_settings (timezone)")
+
+
+def _migration_conversation_activity(c):
+    # Ultima attivita' di ogni conversazione salvata (timestamp unix), per scartare quelle scadute
+    _add_column(c, "conversations", "updated_at", "REAL NOT NULL DEFAULT 0")
+    c.execute("UPDATE conversations SET updated_at = ?", (datetime.now().timestamp(),))
+
+
+def _migration_reparse_ingredients(c):
+    # Il parser degli ingredienti e' cambiato: i risultati salvati si ricalcolano al prossimo uso
+    c.execute("DELETE FROM recipe_ingredients")
+
+
+def _migration_drop_day_reminder_index(c):
+    # I reminder arrivano dalla timing wheel e le ricerche per giorno partono sempre da user_id
+    # (idx_meals_user_day_time): questo indice rallentava solo le scritture
+    c.execute("DROP INDEX IF EXISTS idx_meals_day_reminder")
+
+
+# Migrazioni in ordine: la versione dello schema e' il numero di quelle applicate.
+# Non modificare quelle esistenti, aggiungerne di nuove in coda.
+MIGRATIONS = [
+    _migration_base_tables,
+    _migration_minute_columns,
+    _migration_user_indexes,
+    _migration_sent_reminders,
+    _migration_shards,
+    _migration_persistence,
+    _migration_recipes,
+    _migration_progress_summary,
+    _migration_progress_charts,
+    _migration_recipe_ingredients,
+    _migration_timezones,
+    _migration_conversation_activity,
+    _migration_reparse_ingredients,
+    _migration_drop_day_reminder_index,
+    _migration_reparse_ingredients,
+]
+
+
+def init_db():
+    conn = _configure_connection(sqlite3.connect(DB_PATH, isolation_level=None))
+    c = conn.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    c.execute("SELECT MAX(version) FROM schema_version")
+    version = c.fetchone()[0] or 0
+    if version >= len(MIGRATIONS):
+        conn.close()
+        return
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        # Ogni migrazione e' atomica: DDL e dati nella stessa transazione
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            migration(c)
+            c.execute("INSERT INTO schema_version (version) VALUES (?)", (number,))
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        logger.info(f"Migrazione database {number} applicata ({migration.__name__})")
+    conn.close()
+
+
+def _configure_connection(conn):
+    # WAL: i lettori non bloccano lo scrittore e viceversa
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+    return conn
+
+
+class _Write:
+    __slots__ = ("sql", "params", "fn", "args", "future")
+
+    def __init__(self, future, sql=None, params=(), fn=None, args=()):
+        self.future = future
+        self.sql = sql
+        self.params = params
+        self.fn = fn
+        self.args = args
+
+    @property
+    def batchable(self):
+        # INSERT semplici con lo stesso SQL si possono unire in un executemany
+        return self.fn is None and self.sql.lstrip().upper().startswith("INSERT INTO")
+
+
+class Database:
+    """Accesso asincrono a SQLite tramite thread dedicati.
+
+    Le letture girano su un pool di thread, ognuno con la propria connessione
+    sempre aperta. Tutte le scritture passano da un'unica connessione di
+    scrittura: vengono messe in coda e applicate a gruppi in una sola
+    transazione, cosi' non si contendono mai il lock del database.
+    """
+
+    def __init__(self, path, pool_size=DB_POOL_SIZE):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="db")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._write_queue = asyncio.Queue()
+        self._writer_task = None
+
+    def _connection(self, **kwargs):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=DB_TIMEOUT, check_same_thread=False, **kwargs)
+            _configure_connection(conn)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def _fetchall(self, sql, params):
+        return self._connection().execute(sql, params).fetchall()
+
+    def _fetchone(self, sql, params):
+        return self._connection().execute(sql, params).fetchone()
+
+    async def fetchall(self, sql, params=()):
+        return await self._run(self._fetchall, sql, params)
+
+    async def fetchone(self, sql, params=()):
+        return await self._run(self._fetchone, sql, params)
+
+    async def read(self, fn, *args):
+        """Esegue fn(connection, *args) su un thread di lettura, per letture lunghe a blocchi."""
+        return await self._run(lambda: fn(self._connection(), *args))
+
+    # ── Scritture ──
+    async def _enqueue(self, **kwargs):
+        if self._writer_task is None:
+            self._writer_task = asyncio.create_task(self._writer_loop())
+        write = _Write(asyncio.get_running_loop().create_future(), **kwargs)
+        await self._write_queue.put(write)
+        return await write.future
+
+    async def execute(self, sql, params=()):
+        """Esegue una scrittura e restituisce il numero di righe toccate."""
+        return await self._enqueue(sql=sql, params=params)
+
+    async def executemany(self, sql, seq_of_params):
+        return await self.transaction(lambda c: c.executemany(sql, seq_of_params).rowcount)
+
+    async def transaction(self, fn, *args):
+        """Esegue fn(cursor, *args) sulla connessione di scrittura, in modo atomico."""
+        return await self._enqueue(fn=fn, args=args)
+
+    async def _writer_loop(self):
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            write = await self._write_queue.get()
+            if write is None:
+                break
+            batch = [write]
+            await asyncio.sleep(DB_WRITE_BATCH_DELAY)
+            while len(batch) < DB_WRITE_BATCH_MAX and not self._write_queue.empty():
+                write = self._write_queue.get_nowait()
+                if write is None:
+                    closing = True
+                    break
+                batch.append(write)
+
+            try:
+                results = await loop.run_in_executor(self._writer, self._write_batch, batch)
+            except Exception as e:
+                logger.error(f"Errore transazione di scrittura ({len(batch)} scritture): {e}")
+                results = [(None, e)] * len(batch)
+            for write, (result, error) in zip(batch, results):
+                if write.future.done():
+                    continue
+                if error is None:
+                    write.future.set_result(result)
+                else:
+                    write.future.set_exception(error)
+
+    def _write_batch(self, batch):
+        c = self._connection(isolation_level=None).cursor()
+        results = []
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            group = [batch[0]]
+            for write in batch[1:]:
+                if write.batchable and group[-1].batchable and write.sql == group[-1].sql:
+                    group.append(write)
+                else:
+                    results.extend(self._apply_writes(c, group))
+                    group = [write]
+            results.extend(self._apply_writes(c, group))
+            c.execute("COMMIT")
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+        return results
+
+    def _apply_writes(self, c, group):
+        # Un savepoint per gruppo: una scrittura che fallisce non annulla le altre del batch
+        c.execute("SAVEPOINT write")
+        try:
+            if len(group) > 1:
+                c.executemany(group[0].sql, [write.params for write in group])
+                results = [(1, None)] * len(group)
+            elif group[0].fn is not None:
+                results = [(group[0].fn(c, *group[0].args), None)]
+            else:
+                results = [(c.execute(group[0].sql, group[0].params).rowcount, None)]
+            c.execute("RELEASE write")
+            return results
+        except Exception as e:
+            c.execute("ROLLBACK TO write")
+            c.execute("RELEASE write")
+            if len(group) == 1:
+                return [(None, e)]
+            # Riprova una per una per isolare la scrittura che ha fallito
+            results = []
+            for write in group:
+                results.extend(self._apply_writes(c, [write]))
+            return results
+
+    async def close(self):
+        if self._writer_task is not None:
+            await self._write_queue.put(None)
+            await self._writer_task
+            self._writer_task = None
+        self._writer.shutdown(wait=True)
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+db = Database(DB_PATH)
+
+
+# ── Persistenza conversazioni ───────────────────────────────────
+class SQLitePersistence(BasePersistence):
+    """Salva user_data e stati delle ConversationHandler nel database del bot.
+
+    PTB chiama update_* ogni PERSISTENCE_INTERVAL secondi solo per gli utenti
+    e le conversazioni toccati; qui si scrive solo se il contenuto e' davvero
+    cambiato, e le scritture finiscono nella stessa transazione del writer.
+    user_data viene letto pigramente, al primo update di ogni utente.
+    Le conversazioni aperte sono poche e si caricano tutte all'avvio, tranne le scadute.
+    """
+
+    def __init__(self, database, update_interval=PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.db = database
+        self._saved = {}  # user_id -> hash del JSON salvato (None se non c'e' riga); presente = gia' caricato
+        self._seen = OrderedDict()  # user_id -> ultimo update (monotonic), dal meno recente
+        self._evicting = set()  # tolti dalla memoria: il drop_user_data di PTB non deve cancellare la riga
+
+    @staticmethod
+    def _dumps(value):
+        return json.dumps(value, sort_keys=True, separators=(",", ":"))
+
+    @classmethod
+    def _digest(cls, data):
+        return hash(cls._dumps(data)) if data else None
+
+    # ── Limiti di memoria ──
+    def idle_users(self, max_idle, max_users):
+        """Utenti inattivi da piu' di max_idle secondi, piu' i meno recenti oltre max_users."""
+        limit = monotonic() - max_idle
+        excess = len(self._seen) - max_users
+        users = []
+        for user_id, seen in self._seen.items():
+            if seen >= limit and len(users) >= excess:
+                break
+            users.append(user_id)
+        return users
+
+    def tracks(self, user_id):
+        return user_id in self._seen
+
+    @property
+    def active_users(self):
+        return len(self._seen)
+
+    def evict(self, user_id, data):
+        """Dimentica un utente gia' salvato; False se ha modifiche non ancora scritte."""
+        if self._digest(data) != self._saved.get(user_id):
+            return False
+        self._saved.pop(user_id, None)
+        self._seen.pop(user_id, None)
+        self._evicting.add(user_id)
+        return True
+
+    # ── user_data ──
+    async def get_user_data(self):
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        self._seen[user_id] = monotonic()
+        self._seen.move_to_end(user_id)
+        if user_id in self._saved:
+            return
+        row = await self.db.fetchone("SELECT data FROM user_data WHERE user_id = ?", (user_id,))
+        if row is None:
+            self._saved[user_id] = None
+            return
+        # Dati in memoria scritti prima del caricamento hanno la precedenza
+        user_data.update({k: v for k, v in json.loads(row[0]).items() if k not in user_data})
+        self._saved[user_id] = hash(row[0])
+
+    async def update_user_data(self, user_id, data):
+        if user_id not in self._saved:
+            return  # mai caricato: nessun handler l'ha potuto modificare
+        digest = self._digest(data)
+        if digest == self._saved[user_id]:
+            return
+        self._saved[user_id] = digest
+        if digest is None:
+            await self.db.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+        else:
+            await self.db.execute(
+                "INSERT INTO user_data (user_id, data) VALUES (?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET data = excluded.data",
+                (user_id, self._dumps(data)),
+            )
+
+    async def drop_user_data(self, user_id):
+        if user_id in self._evicting:
+            self._evicting.discard(user_id)
+            return
+        self._saved.pop(user_id, None)
+        self._seen.pop(user_id, None)
+        await self.db.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+
+    # ── Conversazioni ──
+    async def get_conversations(self, name):
+        # Dopo un riavvio PTB non ricrea il job di timeout: le conversazioni gia'
+        # scadute si chiudono qui, con le chiavi del flusso in user_data
+        expired = await self.db.transaction(
+            self._drop_expired, name, datetime.now().timestamp() - CONVERSATION_TIMEOUT
+        )
+        if expired:
+            logger.info(f"Conversazioni {name!r} scadute scartate all'avvio: {expired}")
+        rows = await self.db.fetchall("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    @staticmethod
+    def _drop_expired(c, name, cutoff):
+        c.execute("DELETE FROM conversations WHERE name = ? AND updated_at < ? RETURNING key", (name, cutoff))
+        # La chiave della conversazione e' (chat_id, user_id)
+        user_ids = [json.loads(key)[-1] for key, in c.fetchall()]
+        paths = [f"$.{key}" for key in FLOW_KEYS.get(name, ())]
+        if paths:
+            c.executemany(
+                f"UPDATE user_data SET data = json_remove(data, {', '.join('?' * len(paths))}) WHERE user_id = ?",
+                [(*paths, user_id) for user_id in user_ids],
+            )
+        return len(user_ids)
+
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            await self.db.execute(
+                "DELETE FROM conversations WHERE name = ? AND key = ?", (name, self._dumps(key))
+            )
+        else:
+            await self.db.execute(
+                "INSERT INTO conversations (name, key, state, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (name, key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                (name, self._dumps(key), self._dumps(new_state), datetime.now().timestamp()),
+            )
+
+    # ── Dati non salvati (store_data li esclude) ──
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
         pass
-    # Migrazione: rinomina colonna reminder se necessario
-    try:
-        c.execute("ALTER TABLE meals ADD COLUMN reminder_minutes_before INTEGER DEFAULT 120")
-    except sqlite3.OperationalError:
+
+    async def update_bot_data(self, data):
         pass
-    conn.commit()
-    conn.close()
 
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        # Le scritture sono gia' in coda sul writer; db.close() in post_shutdown le completa
+        pass
+
+
+# ── Fusi orari ──────────────────────────────────────────────────
+@lru_cache(maxsize=None)
+def get_zone(name):
+    """ZoneInfo per nome IANA (es. "Europe/Rome"); ValueError se non esiste."""
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError) as e:
+        raise ValueError(f"Fuso orario sconosciuto: {name}") from e
+
+
+def utc_now():
+    return datetime.now(timezone.utc)
+
+
+def utc_offset(zone, now):
+    """Scarto del fuso da UTC in minuti all'istante now (cambia con l'ora legale)."""
+    return int(now.astimezone(get_zone(zone)).utcoffset().total_seconds()) // 60
+
+
+async def user_now(user_id):
+    """Data e ora correnti nel fuso dell'utente."""
+    row = await db.fetchone("SELECT timezone FROM user_settings WHERE user_id = ?", (user_id,))
+    return utc_now().astimezone(get_zone(row[0] if row and row[0] else DEFAULT_TIMEZONE))
+
+
+async def zone_clocks(now):
+    """Per ogni fuso in uso: (fuso, data locale, giorno della settimana, minuto del giorno)."""
+    rows = await db.fetchall("SELECT DISTINCT timezone FROM user_settings WHERE timezone IS NOT NULL")
+    clocks = []
+    for zone in {DEFAULT_TIMEZONE, *(row[0] for row in rows)}:
+        local = now.astimezone(get_zone(zone))
+        clocks.append((zone, local.strftime("%Y-%m-%d"), local.weekday(), local.hour * 60 + local.minute))
+    return clocks
+
+
+def zones_cte(clocks):
+    """Tabella `zones (name, date, day, minute)` con l'ora locale dei fusi, da mettere in testa a una query."""
+    values = ", ".join(["(?, ?, ?, ?)"] * len(clocks))
+    return f"WITH zones (name, date, day, minute) AS (VALUES {values}) ", [value for clock in clocks for value in clock]
+
+
+# ── Scheduler reminder pasti ────────────────────────────────────
+def parse_minute(hhmm):
+    """'HH:MM' -> minuti dalla mezzanotte."""
+    hour, minute = map(int, hhmm.split(":"))
+    return hour * 60 + minute
+
+
+def meal_minutes(meal_time, reminder_minutes):
+    """Restituisce (meal_minute, reminder_minute) per le colonne intere di `meals`.
+
+    reminder_minute e' relativo al giorno del pasto: negativo se il reminder
+    cade il giorno prima. "La mattina stessa" (-1) vale sempre le 8:00.
+    """
+    meal_minute = parse_minute(meal_time)
+    if reminder_minutes == -1:
+        return meal_minute, 8 * 60
+    return meal_minute, meal_minute - reminder_minutes
+
+
+def reminder_minute_of_week(day_of_week, reminder_minute):
+    """Minuto della settimana (0 = lunedi 00:00) in cui scatta il reminder."""
+    # Un reminder prima di mezzanotte cade nel giorno precedente
+    return (day_of_week * MINUTES_PER_DAY + reminder_minute) % MINUTES_PER_WEEK
+
+
+def minute_of_week(dt):
+    return dt.weekday() * MINUTES_PER_DAY + dt.hour * 60 + dt.minute
+
+
+class ShardManager:
+    """Divide gli utenti tra i worker con lease rinnovati nella tabella shard_leases.
+
+    Ad ogni heartbeat il worker rinnova i propri lease, prende quelli scaduti
+    (worker morti) fino alla sua quota e cede quelli in eccesso quando
+    arrivano altri worker. Il proprietario dello shard 0 fa da leader per i
+    lavori globali.
+    """
+
+    def __init__(self, count=SHARD_COUNT, worker_id=WORKER_ID, lease_seconds=SHARD_LEASE_SECONDS):
+        self.count = count
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.owned = frozenset()
+
+    def owns(self, user_id):
+        return user_id % self.count in self.owned
+
+    @property
+    def is_leader(self):
+        return 0 in self.owned
+
+    def sql_filter(self, column, only=None):
+        """Condizione SQL (e parametri) che limita una query agli utenti dei nostri shard (o di `only`)."""
+        shards = sorted(self.owned if only is None else only)
+        return f"{column} % ? IN ({', '.join('?' * len(shards))})", (self.count, *shards)
+
+    def _renew(self, c):
+        # Gira nella transazione di scrittura: lettura e aggiornamento dei lease sono atomici
+        now = datetime.now().timestamp()
+        c.execute(
+            "INSERT OR REPLACE INTO workers (worker_id, expires_at) VALUES (?, ?)",
+            (self.worker_id, now + self.lease_seconds),
+        )
+        c.execute("DELETE FROM workers WHERE expires_at < ?", (now,))
+        c.execute("SELECT COUNT(*) FROM workers")
+        quota = -(-self.count // c.fetchone()[0])
+
+        c.executemany("INSERT OR IGNORE INTO shard_leases (shard) VALUES (?)", [(s,) for s in range(self.count)])
+        c.execute("SELECT shard, owner, expires_at FROM shard_leases WHERE shard < ?", (self.count,))
+        rows = c.fetchall()
+        mine = [shard for shard, owner, expires_at in rows if owner == self.worker_id and expires_at >= now]
+        free = [shard for shard, owner, expires_at in rows if expires_at < now]
+        # Cede uno shard per giro, cosi' un worker appena arrivato trova lavoro
+        if len(mine) > quota:
+            c.execute(
+                "UPDATE shard_leases SET owner = NULL, expires_at = 0 WHERE shard = ? AND owner = ?",
+                (mine.pop(), self.worker_id),
+            )
+        mine.extend(free[:max(0, quota - len(mine))])
+        c.executemany(
+            "UPDATE shard_leases SET owner = ?, expires_at = ? WHERE shard = ?",
+            [(self.worker_id, now + self.lease_seconds, shard) for shard in mine],
+        )
+        return frozenset(mine)
+
+    async def heartbeat(self):
+        """Rinnova i lease; restituisce (shard acquisiti, shard persi)."""
+        owned = await db.transaction(self._renew)
+        gained, lost = owned - self.owned, self.owned - owned
+        self.owned = owned
+        if gained or lost:
+            logger.info(f"Worker {self.worker_id}: shard {sorted(owned)} (+{sorted(gained)} -{sorted(lost)})")
+        return gained, lost
+
+
+shards = ShardManager()
+
+
+class ReminderWheel:
+    """Timing wheel dei reminder: una casella per ogni minuto della settimana in UTC.
+
+    Ogni pasto viene calcolato una sola volta e messo nella casella del suo
+    reminder, convertito in UTC con lo scarto attuale del fuso dell'utente:
+    i pasti di tutti i fusi stanno nello stesso indice. Quando lo scarto di un
+    fuso cambia (ora legale) i suoi pasti vengono ricollocati. Ad ogni tick si
+    leggono solo le caselle scadute dall'ultimo tick, senza mai tornare
+    indietro di piu' di `grace_minutes` (anche all'avvio).
+    Contiene solo i pasti degli utenti per cui `owns(user_id)` e' vero.
+    """
+
+    def __init__(self, owns, grace_minutes=REMINDER_GRACE_MINUTES):
+        self.owns = owns
+        self.grace_minutes = grace_minutes
+        self._slots = defaultdict(set)  # minuto UTC della settimana -> {meal_id}
+        self._slot_of = {}  # meal_id -> (minuto UTC, user_id, fuso, minuto locale della settimana)
+        self._zones = defaultdict(set)  # fuso -> {meal_id}
+        self._offsets = {}  # fuso -> scarto da UTC (minuti) con cui sono calcolate le caselle
+        self._catch_up = []  # reminder da recuperare per utenti appena acquisiti
+        self._last_tick = None
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def add(self, meal_id, user_id, day_of_week, reminder_minute, zone):
+        self.remove(meal_id)
+        if not self.owns(user_id):
+            return
+        if zone not in self._offsets:
+            self._offsets[zone] = utc_offset(zone, utc_now())
+        self._place(meal_id, user_id, zone, reminder_minute_of_week(day_of_week, reminder_minute))
+
+    def _place(self, meal_id, user_id, zone, local_minute):
+        slot = (local_minute - self._offsets[zone]) % MINUTES_PER_WEEK
+        self._slots[slot].add(meal_id)
+        self._slot_of[meal_id] = (slot, user_id, zone, local_minute)
+        self._zones[zone].add(meal_id)
+
+    def _unplace(self, meal_id):
+        slot, user_id, zone, local_minute = self._slot_of.pop(meal_id)
+        self._slots[slot].discard(meal_id)
+        if not self._slots[slot]:
+            del self._slots[slot]
+        return user_id, zone, local_minute
+
+    def remove(self, meal_id):
+        if meal_id not in self._slot_of:
+            return
+        _, zone, _ = self._unplace(meal_id)
+        self._zones[zone].discard(meal_id)
+        if not self._zones[zone]:
+            del self._zones[zone]
+            del self._offsets[zone]
+
+    def drop_unowned(self):
+        for meal_id, (_, user_id, _, _) in list(self._slot_of.items()):
+            if not self.owns(user_id):
+                self.remove(meal_id)
+
+    def refresh_offsets(self, now):
+        """Ricolloca i pasti dei fusi il cui scarto da UTC e' cambiato; restituisce quei fusi."""
+        changed = []
+        for zone, meal_ids in self._zones.items():
+            offset = utc_offset(zone, now)
+            if offset == self._offsets[zone]:
+                continue
+            self._offsets[zone] = offset
+            for meal_id in list(meal_ids):
+                user_id, _, local_minute = self._unplace(meal_id)
+                self._place(meal_id, user_id, zone, local_minute)
+            changed.append(zone)
+        return changed
+
+    def _collect(self, start, end, meal_ids=None):
+        due = []
+        tick = start + timedelta(minutes=1)
+        while tick <= end:
+            for meal_id in self._slots.get(minute_of_week(tick), ()):
+                if meal_ids is None or meal_id in meal_ids:
+                    # La data del registro e' quella locale dell'utente
+                    zone = self._slot_of[meal_id][2]
+                    due.append((meal_id, tick.astimezone(get_zone(zone)).strftime("%Y-%m-%d")))
+            tick += timedelta(minutes=1)
+        return due
+
+    def add_catch_up(self, meal_ids, now):
+        """Recupera i reminder gia' passati dal tick per pasti appena acquisiti (entro il margine)."""
+        if self._last_tick is None:
+            return  # il primo tick recupera gia' tutto il margine
+        oldest = now.replace(second=0, microsecond=0) - timedelta(minutes=self.grace_minutes)
+        self._catch_up.extend(self._collect(oldest, self._last_tick, set(meal_ids)))
+
+    def due(self, now):
+        """Restituisce (meal_id, data locale 'YYYY-MM-DD') dei reminder scaduti tra l'ultimo tick e `now` (UTC)."""
+        now = now.replace(second=0, microsecond=0)
+        for zone in self.refresh_offsets(now):
+            logger.info(f"Ora legale: caselle dei reminder ricalcolate per {zone}")
+            # Pasti finiti in caselle appena passate (ora saltata): recuperati entro il margine
+            self.add_catch_up(self._zones[zone], now)
+        oldest = now - timedelta(minutes=self.grace_minutes)
+        if self._last_tick is None or self._last_tick < oldest:
+            self._last_tick = oldest
+        due, self._catch_up = self._catch_up, []
+        due.extend(self._collect(self._last_tick, now))
+        if now > self._last_tick:
+            self._last_tick = now
+        return due
+
+
+reminder_wheel = ReminderWheel(shards.owns)
+_last_schedule_change = 0
+
+
+def _log_schedule_changes(c, changes):
+    """Registra (meal_id, user_id) modificati, per le timing wheel degli altri worker."""
+    changed_at = datetime.now().timestamp()
+    c.executemany(
+        "INSERT INTO schedule_changes (meal_id, user_id, changed_at) VALUES (?, ?, ?)",
+        [(meal_id, user_id, changed_at) for meal_id, user_id in changes],
+    )
+
+
+# Pasti come argomenti di ReminderWheel.add, con il fuso dell'utente
+_SQL_WHEEL_MEALS = (
+    "SELECT m.id, m.user_id, m.day_of_week, m.reminder_minute, COALESCE(s.timezone, ?) "
+    "FROM meals m LEFT JOIN user_settings s ON s.user_id = m.user_id"
+)
+
+
+async def load_owned_meals(only=None, now=None):
+    """Carica nella timing wheel i pasti degli shard posseduti (o di `only`).
+
+    Con `now` recupera anche i reminder appena passati, per gli shard presi
+    in carico da un worker morto.
+    """
+    condition, params = shards.sql_filter("m.user_id", only)
+    rows = await db.fetchall(f"{_SQL_WHEEL_MEALS} WHERE {condition}", (DEFAULT_TIMEZONE, *params))
+    for row in rows:
+        reminder_wheel.add(*row)
+    if now is not None:
+        reminder_wheel.add_catch_up([row[0] for row in rows], now)
+    return len(rows)
+
+
+async def load_reminder_wheel():
+    global _last_schedule_change
+    await shards.heartbeat()
+    # Il cursore delle modifiche va letto prima dei pasti, per non perderne nessuna
+    _last_schedule_change = (await db.fetchone("SELECT COALESCE(MAX(seq), 0) FROM schedule_changes"))[0]
+    await load_owned_meals()
+    logger.info(f"Scheduler reminder: {len(reminder_wheel)} pasti in calendario")
+
+
+async def schedule_meals(meal_ids):
+    """Ricalcola la casella dei pasti indicati dopo un inserimento, una modifica o una cancellazione."""
+    if not meal_ids:
+        return
+    meal_ids = set(meal_ids)
+    placeholders = ", ".join("?" * len(meal_ids))
+    rows = await db.fetchall(f"{_SQL_WHEEL_MEALS} WHERE m.id IN ({placeholders})", (DEFAULT_TIMEZONE, *meal_ids))
+    for row in rows:
+        reminder_wheel.add(*row)
+    for meal_id in meal_ids - {row[0] for row in rows}:
+        reminder_wheel.remove(meal_id)
+
+
+async def shard_heartbeat(context: ContextTypes.DEFAULT_TYPE):
+    """Rinnova i lease degli shard e applica alla timing wheel le modifiche fatte da altri processi."""
+    global _last_schedule_change
+    gained, lost = await shards.heartbeat()
+    if lost:
+        reminder_wheel.drop_unowned()
+
+    rows = await db.fetchall(
+        "SELECT seq, meal_id, user_id FROM schedule_changes WHERE seq > ? ORDER BY seq",
+        (_last_schedule_change,),
+    )
+    if rows:
+        _last_schedule_change = rows[-1][0]
+        # Pasti cambiati anche da altri processi: i piani in cache di questi utenti sono vecchi
+        for user_id in {user_id for _, _, user_id in rows}:
+            plan_cache.invalidate(user_id)
+        await schedule_meals([meal_id for _, meal_id, user_id in rows if shards.owns(user_id)])
+    if gained:
+        await load_owned_meals(only=gained, now=utc_now())
+
+
+# ── Ricette ─────────────────────────────────────────────────────
+# Da chiamare dentro db.transaction: i contatori dei riferimenti cambiano insieme ai pasti
+def _acquire_recipe(c, user_id, meal_name, recipe, count=1):
+    """Id della ricetta con questo contenuto (creata se manca), con count riferimenti in piu'."""
+    c.execute(
+        "INSERT INTO recipes (user_id, hash, meal_name, recipe, refcount) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (user_id, hash) DO UPDATE SET refcount = refcount + excluded.refcount RETURNING id",
+        (user_id, recipe_hash(meal_name, recipe), meal_name, recipe, count),
+    )
+    return c.fetchone()[0]
+
+
+def _retain_recipes(c, recipe_ids):
+    """Aggiunge un riferimento per ogni id (ripetuto se serve)."""
+    counts = Counter(recipe_ids)
+    c.executemany("UPDATE recipes SET refcount = refcount + ? WHERE id = ?", [(n, rid) for rid, n in counts.items()])
+
+
+def _release_recipes(c, recipe_ids):
+    """Toglie un riferimento per ogni id (ripetuto se serve) e cancella le ricette non piu' usate."""
+    counts = Counter(recipe_ids)
+    c.executemany("UPDATE recipes SET refcount = refcount - ? WHERE id = ?", [(n, rid) for rid, n in counts.items()])
+    c.executemany("DELETE FROM recipes WHERE id = ? AND refcount <= 0", [(rid,) for rid in counts])
+
+
+def _update_recipe(c, user_id, recipe_id, meal_name, recipe):
+    """Cambia il contenuto di una ricetta per tutti i pasti che la usano.
+
+    Se l'utente ha gia' una ricetta identica, i pasti passano a quella.
+    """
+    digest = recipe_hash(meal_name, recipe)
+    c.execute("SELECT id FROM recipes WHERE user_id = ? AND hash = ?", (user_id, digest))
+    row = c.fetchone()
+    if row is None:
+        c.execute(
+            "UPDATE recipes SET hash = ?, meal_name = ?, recipe = ? WHERE id = ?",
+            (digest, meal_name, recipe, recipe_id),
+        )
+    elif row[0] != recipe_id:
+        c.execute("UPDATE meals SET recipe_id = ? WHERE recipe_id = ?", (row[0], recipe_id))
+        c.execute(
+            "UPDATE recipes SET refcount = refcount + (SELECT refcount FROM recipes WHERE id = ?) WHERE id = ?",
+            (recipe_id, row[0]),
+        )
+        c.execute("DELETE FROM recipes WHERE id = ?", (recipe_id,))
+
+
+# ── Lista spesa ─────────────────────────────────────────────────
+# Unita' riconosciute -> (unita' in cui si sommano, fattore di conversione)
+INGREDIENT_UNITS = {
+    "g": ("g", 1), "gr": ("g", 1), "grammi": ("g", 1), "hg": ("g", 100), "etti": ("g", 100),
+    "kg": ("g", 1000), "ml": ("ml", 1), "cl": ("ml", 10), "dl": ("ml", 100), "l": ("ml", 1000),
+    "lt": ("ml", 1000), "litri": ("ml", 1000), "litro": ("ml", 1000),
+    "cucchiaio": ("cucchiai", 1), "cucchiai": ("cucchiai", 1),
+    "cucchiaino": ("cucchiaini", 1), "cucchiaini": ("cucchiaini", 1),
+    "tazza": ("tazze", 1), "tazze": ("tazze", 1), "fetta": ("fette", 1), "fette": ("fette", 1),
+    "vasetto": ("vasetti", 1), "vasetti": ("vasetti", 1), "scatoletta": ("scatolette", 1),
+    "scatolette": ("scatolette", 1), "spicchio": ("spicchi", 1), "spicchi": ("spicchi", 1),
+    "pz": (None, 1), "pezzo": (None, 1), "pezzi": (None, 1),
+}
+INGREDIENT_NUMBER_WORDS = {"un": 1, "uno": 1, "una": 1, "mezzo": 0.5, "mezza": 0.5, "due": 2, "tre": 3, "quattro": 4}
+
+_NUMBER_WORDS = "|".join(sorted(INGREDIENT_NUMBER_WORDS, key=len, reverse=True))
+_NUMBER = rf"\d+(?:[.,]\d+)?(?:/\d+)?|½|(?:{_NUMBER_WORDS})\b"
+_UNIT = "|".join(sorted(map(re.escape, INGREDIENT_UNITS), key=len, reverse=True))
+# "150g pollo", "2 cucchiai di olio", "mezzo avocado" ...
+_QUANTITY_FIRST = re.compile(rf"^(?P<qty>{_NUMBER})\s*(?:(?P<unit>{_UNIT})\b\.?)?\s*(?:di\s+|d')?(?P<item>.+)$")
+# ... oppure "pollo 150g", "uova 2"
+_QUANTITY_LAST = re.compile(rf"^(?P<item>.+?)\s+(?P<qty>{_NUMBER})\s*(?:(?P<unit>{_UNIT})\b\.?)?$")
+# La virgola tra due cifre e' un decimale ("0,5 l latte"), non un separatore; " e " separa
+# solo se segue una quantita' ("150g pollo e 80g riso"), non nei nomi ("pasta e fagioli")
+_INGREDIENT_SEPARATORS = re.compile(
+    rf"[;+\n]|(?<!\d),|,(?!\d)|\s+e\s+(?=\d|½|(?:{_NUMBER_WORDS})\b)"
+)
+_PARENTHESES = re.compile(r"\(([^()]*)\)")
+_BARE_QUANTITY = re.compile(rf"^\s*(?:{_NUMBER})\s*(?:(?:{_UNIT})\b\.?)?\s*$")
+_TO_TASTE = re.compile(r"\s*\bq\.?\s?b\.?$")
+
+
+def _parse_number(text):
+    if text in INGREDIENT_NUMBER_WORDS:
+        return INGREDIENT_NUMBER_WORDS[text]
+    if text == "½":
+        return 0.5
+    text = text.replace(",", ".")
+    if "/" in text:
+        numerator, denominator = text.split("/")
+        return float(numerator) / float(denominator) if float(denominator) else None
+    return float(text)
+
+
+def parse_ingredients(recipe):
+    """Lista di [ingrediente, quantita', unita'] da un testo come "150g pollo, 80g riso".
+
+    Quantita' e unita' sono None quando mancano (es. "sale q.b."); le unita'
+    sono gia' convertite in quelle di INGREDIENT_UNITS, i pezzi non hanno unita'.
+    Le parentesi con sole quantita' valgono per la parola prima ("tonno (1 scatoletta)");
+    le altre con quantita' sono liste di ingredienti, che si aggiungono al testo fuori
+    o lo sostituiscono se fuori non ci sono quantita' ("Pollo con riso (150g pollo, 80g riso)").
+    Se nessun pezzo ha una quantita' la ricetta e' testo libero e torna intera.
+    """
+    text = _PARENTHESES.sub(lambda m: f" {m[1]} " if _BARE_QUANTITY.match(m[1]) else m[0], recipe.lower())
+    groups = [_parse_ingredient_list(group) for group in _PARENTHESES.findall(text)]
+    bracketed = [item for group in groups if _has_quantity(group) for item in group]
+    outside = _parse_ingredient_list(_PARENTHESES.sub(" ", text))
+    if _has_quantity(outside):
+        return outside + bracketed
+    if bracketed:
+        return bracketed
+    ingredients = _parse_ingredient_list(text.replace("(", " ").replace(")", " "))
+    if _has_quantity(ingredients):
+        return ingredients
+    return [[" ".join(recipe.split()), None, None]]
+
+
+def _has_quantity(ingredients):
+    return any(quantity is not None for _, quantity, _ in ingredients)
+
+
+def _parse_ingredient_list(text):
+    ingredients = []
+    for part in _INGREDIENT_SEPARATORS.split(text):
+        part = _TO_TASTE.sub("", " ".join(part.split()).strip(" .:-•*"))
+        if not part:
+            continue
+        # "con" separa solo dopo una quantita' ("pasta 80g con tonno"): "riso con verdure" e' un nome
+        while " con " in part:
+            head, tail = part.split(" con ", 1)
+            ingredient = _parse_ingredient(head)
+            if ingredient[1] is None:
+                break
+            ingredients.append(ingredient)
+            part = tail
+        ingredients.append(_parse_ingredient(part))
+    return ingredients
+
+
+def _parse_ingredient(part):
+    match = _QUANTITY_FIRST.match(part) or _QUANTITY_LAST.match(part)
+    # In "1 scatoletta" l'unita' e' tutto il pezzo: non dice di quale ingrediente
+    if match is None or match["unit"] is None and match["item"].strip(" .:-") in INGREDIENT_UNITS:
+        return [part, None, None]
+    quantity = _parse_number(match["qty"])
+    unit, factor = INGREDIENT_UNITS.get(match["unit"], (None, 1))
+    return [match["item"].strip(" .:-"), None if quantity is None else quantity * factor, unit]
+
+
+def _store_ingredients(c, parsed):
+    c.executemany(
+        "INSERT INTO recipe_ingredients (hash, ingredients) VALUES (?, ?) ON CONFLICT (hash) DO NOTHING",
+        parsed,
+    )
+
+
+async def recipe_ingredients(rows):
+    """Ingredienti per righe (hash, ricetta, ingredienti salvati o None), nello stesso ordine.
+
+    Le ricette mai viste vengono analizzate qui e salvate: le volte
+    successive si legge solo il risultato.
+    """
+    result, new = [], {}
+    for digest, recipe, stored in rows:
+        if stored is not None:
+            result.append(json.loads(stored))
+            continue
+        if digest not in new:
+            new[digest] = parse_ingredients(recipe)
+        result.append(new[digest])
+    if new:
+        await db.transaction(_store_ingredients, [(digest, json.dumps(v)) for digest, v in new.items()])
+    return result
+
+
+def _format_quantity(quantity, unit):
+    if unit == "g" and quantity >= 1000:
+        quantity, unit = quantity / 1000, "kg"
+    elif unit == "ml" and quantity >= 1000:
+        quantity, unit = quantity / 1000, "l"
+    text = f"{round(quantity, 2):g}"
+    return f"{text} {unit}" if unit else text
+
+
+def grocery_lines(ingredient_lists):
+    """Righe della lista spesa da coppie (ingredienti, ripetizioni), sommando per ingrediente e unita'."""
+    totals = defaultdict(float)
+    for ingredients, times in ingredient_lists:
+        for item, quantity, unit in ingredients:
+            # Senza quantita' conta solo che l'ingrediente ci sia
+            totals[item, unit] += (quantity or 0) * times
+    by_item = {}
+    for (item, unit), quantity in totals.items():
+        amounts = by_item.setdefault(item, [])
+        if quantity:
+            amounts.append(_format_quantity(quantity, unit))
+    return [
+        f"• {item}: {' + '.join(amounts)}\n" if amounts else f"• {item}\n"
+        for item, amounts in sorted(by_item.items())
+    ]
+
+
+# Pasti dei giorni indicati con la ricetta e gli ingredienti gia' estratti (se ci sono)
+_SQL_GROCERY_MEALS = (
+    "SELECT m.day_of_week, r.hash, r.recipe, i.ingredients FROM meals m "
+    "JOIN recipes r ON r.id = m.recipe_id LEFT JOIN recipe_ingredients i ON i.hash = r.hash "
+    "WHERE m.user_id = ? AND m.day_of_week IN ({})"
+)
+
+
+async def get_grocery_lines(user_id, first_day, days):
+    """Lista spesa aggregata per days giorni a partire da first_day (giorno della settimana)."""
+    # Il piano e' settimanale: oltre i 7 giorni gli stessi pasti tornano piu' volte
+    times = Counter((first_day + offset) % 7 for offset in range(days))
+    rows = await db.fetchall(
+        _SQL_GROCERY_MEALS.format(", ".join("?" * len(times))),
+        (user_id, *times),
+    )
+    ingredients = await recipe_ingredients([row[1:] for row in rows])
+    return grocery_lines(zip(ingredients, (times[row[0]] for row in rows)))
+
+
+async def spesa(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    days = GROCERY_DEFAULT_DAYS
+    if context.args:
+        try:
+            days = int(context.args[0])
+        except ValueError:
+            days = 0
+        if not 1 <= days <= GROCERY_MAX_DAYS:
+            await update.message.reply_text(f"Uso: /spesa [giorni]  (da 1 a {GROCERY_MAX_DAYS}, es. /spesa 3)")
+            return
+
+    # Come il reminder serale, la lista parte da domani
+    first_day = ((await user_now(update.effective_user.id)).weekday() + 1) % 7
+    lines = await get_grocery_lines(update.effective_user.id, first_day, days)
+    if not lines:
+        await update.message.reply_text(f"🛒 Nessun pasto nei prossimi {days} giorni.\nUsa /aggiungi_pasto!")
+        return
+    last_day = (first_day + days - 1) % 7
+    period = GIORNI[first_day] if days == 1 else f"da {GIORNI[first_day]} a {GIORNI[last_day]}, {days} giorni"
+    message = MessageBuilder(f"🛒 Lista spesa ({period})\n\n")
+    for line in lines:
+        message.add(line)
+    await reply_long(update.message, message)
+
+
+# ── Cache piani settimanali ─────────────────────────────────────
+class UserCache:
+    """LRU con scadenza di valori calcolati per utente.
+
+    Per i piani settimanali il valore e' una tupla di righe
+    (id, day_of_week, meal_name, meal_time, recipe) ordinate per giorno e
+    orario; i testi ripetuti sono lo stesso oggetto. Ogni scrittura sui dati
+    da cui dipende il valore (`meals`, `progress`) deve chiamare invalidate()
+    per l'utente coinvolto.
+    """
+
+    def __init__(self, maxsize=PLAN_CACHE_SIZE, ttl=PLAN_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0  # contatore globale: letto prima di calcolare un valore e passato a put()
+        self._entries = OrderedDict()  # user_id -> (scadenza, piano)
+        self._changed = OrderedDict()  # user_id -> (invalidations dopo l'ultima modifica, quando), dal piu' vecchio
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < monotonic():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user_id, plan, invalidations):
+        # Scarta un piano letto mentre l'utente veniva modificato: potrebbe essere gia' vecchio
+        changed = self._changed.get(user_id)
+        if changed is not None and changed[0] > invalidations:
+            return
+        self._entries[user_id] = (monotonic() + self.ttl, plan)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self.invalidations += 1
+        now = monotonic()
+        self._changed[user_id] = (self.invalidations, now)
+        self._changed.move_to_end(user_id)
+        # Nessuna lettura dura quanto la validita' di un valore: le modifiche piu' vecchie non servono piu'
+        while self._changed and next(iter(self._changed.values()))[1] < now - self.ttl:
+            self._changed.popitem(last=False)
+        self._entries.pop(user_id, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+plan_cache = UserCache()
+
+
+async def get_week_plan(user_id):
+    """Piano settimanale dell'utente, dalla cache se possibile."""
+    plan = plan_cache.get(user_id)
+    if plan is None:
+        invalidations = plan_cache.invalidations
+        rows = await db.fetchall(
+            "SELECT m.id, m.day_of_week, r.meal_name, m.meal_time, r.recipe "
+            "FROM meals m JOIN recipes r ON r.id = m.recipe_id "
+            "WHERE m.user_id = ? ORDER BY m.day_of_week, m.meal_time, m.id",
+            (user_id,),
+        )
+        # Una ricetta copiata su piu' giorni occupa la memoria una volta sola
+        texts = {}
+        plan = tuple(
+            (meal_id, day, texts.setdefault(name, name), meal_time, texts.setdefault(recipe, recipe))
+            for meal_id, day, name, meal_time, recipe in rows
+        )
+        plan_cache.put(user_id, plan, invalidations)
+    return plan
+
+
+async def get_plan_page(user_id, page, size=PLAN_PAGE_SIZE):
+    """Una pagina del piano settimanale: (righe, True se ci sono altre pagine dopo).
+
+    Usa il piano in cache se c'e', altrimenti legge dal database solo la pagina.
+    """
+    plan = plan_cache.get(user_id)
+    if plan is not None:
+        rows = plan[page * size:(page + 1) * size + 1]
+    else:
+        rows = await db.fetchall(
+            "SELECT m.id, m.day_of_week, r.meal_name, m.meal_time, r.recipe "
+            "FROM meals m JOIN recipes r ON r.id = m.recipe_id "
+            "WHERE m.user_id = ? ORDER BY m.day_of_week, m.meal_time, m.id LIMIT ? OFFSET ?",
+            (user_id, size + 1, page * size),
+        )
+    return rows[:size], len(rows) > size
+
+
+# ── Invii in massa ──────────────────────────────────────────────
+class TokenBucket:
+    """Limita le acquisizioni a `rate` al secondo, con burst fino a `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Blocca tutte le acquisizioni per `seconds` (es. dopo un RetryAfter)."""
+        self._paused_until = max(self._paused_until, monotonic() + seconds)
+        self._tokens = 0
+        self._updated = self._paused_until
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastStats:
+    __slots__ = ("label", "sent", "failed", "blocked", "retries", "started")
+
+    def __init__(self, label):
+        self.label = label
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retries = 0
+        self.started = monotonic()
+
+    @property
+    def done(self):
+        return self.sent + self.failed + self.blocked
+
+    def __str__(self):
+        elapsed = monotonic() - self.started
+        rate = self.sent / elapsed if elapsed else 0.0
+        return (
+            f"{self.label}: {self.sent} inviati, {self.failed} falliti, {self.blocked} bloccati, "
+            f"{self.retries} ritentati in {elapsed:.1f}s ({rate:.1f} msg/s)"
+        )
+
+
+def _retry_seconds(retry_after):
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class Broadcaster:
+    """Invia messaggi a molti utenti rispettando i limiti di Telegram.
 
-def get_db():
-    return sqlite3.connect(DB_PATH)
+    Un token bucket condiviso tiene il ritmo globale, un semaforo limita gli
+    invii in corso e un RetryAfter mette in pausa tutti gli invii per il tempo
+    richiesto da Telegram prima di ritentare.
+    """
+
+    def __init__(self, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY, max_retries=BROADCAST_MAX_RETRIES):
+        self.bucket = TokenBucket(rate)
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks = set()
+        self.totals = BroadcastStats("totale")
+
+    def _count(self, stats, field):
+        setattr(stats, field, getattr(stats, field) + 1)
+        setattr(self.totals, field, getattr(self.totals, field) + 1)
+
+    async def _send(self, bot, chat_id, text, stats):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._count(stats, "retries")
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                self._count(stats, "sent")
+                return True
+            except RetryAfter as e:
+                seconds = _retry_seconds(e.retry_after)
+                logger.warning(f"Flood control ({stats.label}): pausa di {seconds:.0f}s")
+                self.bucket.pause(seconds)
+            except Forbidden:
+                # L'utente ha bloccato il bot: inutile ritentare
+                self._count(stats, "blocked")
+                return False
+            except BadRequest as e:
+                logger.error(f"Errore invio {stats.label} a {chat_id}: {e}")
+                break
+            except NetworkError as e:
+                logger.warning(f"Errore di rete inviando {stats.label} a {chat_id}: {e}")
+                await asyncio.sleep(2 ** attempt)
+            except TelegramError as e:
+                logger.error(f"Errore invio {stats.label} a {chat_id}: {e}")
+                break
+        self._count(stats, "failed")
+        return False
+
+    async def _send_and_release(self, bot, chat_id, text, stats):
+        try:
+            await self._send(bot, chat_id, text, stats)
+        finally:
+            self._semaphore.release()
+        if stats.done % BROADCAST_PROGRESS_EVERY == 0:
+            logger.info(f"Invio in corso - {stats}")
+
+    async def submit(self, bot, chat_id, text, stats):
+        """Avvia l'invio appena si libera un posto e restituisce il task."""
+        # Il semaforo limita anche i task creati, non solo le richieste in volo
+        await self._semaphore.acquire()
+        task = asyncio.create_task(self._send_and_release(bot, chat_id, text, stats))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def drain(self):
+        """Attende la fine di tutti gli invii in corso."""
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+broadcaster = Broadcaster()
+
+
+class _OutboxEntry:
+    __slots__ = ("chat_id", "priority", "label", "parts", "length", "ready_at", "sent")
+
+    def __init__(self, chat_id, priority, label, text, ready_at):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.label = label
+        self.parts = [text]
+        self.length = len(text)
+        self.ready_at = ready_at
+        self.sent = False
+
+
+class Outbox:
+    """Coda unica dei messaggi in uscita, con priorita' e accorpamento per chat.
+
+    Ogni messaggio aspetta OUTBOX_COALESCE_SECONDS: cio' che arriva nel
+    frattempo per la stessa chat viene unito in un solo invio. I messaggi
+    pronti partono in ordine di priorita' (prima i reminder pasti, per ultima
+    la motivazione) attraverso il Broadcaster.
+    """
+
+    def __init__(self, broadcaster, coalesce_seconds=OUTBOX_COALESCE_SECONDS):
+        self.broadcaster = broadcaster
+        self.coalesce_seconds = coalesce_seconds
+        self.enqueued = 0
+        self.coalesced = 0
+        self.stats = {}  # label -> BroadcastStats
+        self._open = {}  # chat_id -> _OutboxEntry ancora accorpabile
+        self._waiting = deque()  # entry nella finestra di accorpamento, in ordine di arrivo
+        self._ready = []  # heap di (priorita', seq, entry)
+        self._seq = count()
+        self._wakeup = asyncio.Event()
+        self._bot = None
+        self._task = None
+        self._closing = False
+
+    def __len__(self):
+        return len(self._waiting) + len(self._ready)
+
+    def put(self, chat_id, text, priority, label):
+        self.enqueued += 1
+        entry = self._open.get(chat_id)
+        if entry is not None and entry.length + len(text) + 2 <= TELEGRAM_MAX_MESSAGE_LENGTH:
+            self.coalesced += 1
+            entry.parts.append(text)
+            entry.length += len(text) + 2
+            if priority < entry.priority:
+                entry.priority = priority
+                entry.label = label
+                if entry.ready_at is None:
+                    # Gia' pronta: la reinserisco con la nuova priorita'
+                    heapq.heappush(self._ready, (priority, next(self._seq), entry))
+            return
+        entry = _OutboxEntry(chat_id, priority, label, text, monotonic() + self.coalesce_seconds)
+        self._open[chat_id] = entry
+        self._waiting.append(entry)
+        self._wakeup.set()
+
+    def start(self, bot):
+        self._bot = bot
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Invia subito tutto cio' che e' in coda e attende la fine degli invii."""
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        await self.broadcaster.drain()
+
+    def _promote_ready(self):
+        now = monotonic()
+        while self._waiting and (self._closing or self._waiting[0].ready_at <= now):
+            entry = self._waiting.popleft()
+            entry.ready_at = None
+            heapq.heappush(self._ready, (entry.priority, next(self._seq), entry))
+
+    async def _run(self):
+        while True:
+            self._promote_ready()
+            if self._ready:
+                _, _, entry = heapq.heappop(self._ready)
+                if entry.sent:
+                    continue
+                entry.sent = True
+                if self._open.get(entry.chat_id) is entry:
+                    del self._open[entry.chat_id]
+                stats = self.stats.get(entry.label)
+                if stats is None:
+                    stats = self.stats[entry.label] = BroadcastStats(entry.label)
+                await self.broadcaster.submit(self._bot, entry.chat_id, "\n\n".join(entry.parts), stats)
+                continue
+            if self._closing:
+                return
+            timeout = self._waiting[0].ready_at - monotonic() if self._waiting else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+outbox = Outbox(broadcaster)
+
+
+# ── Messaggi lunghi ─────────────────────────────────────────────
+class MessageBuilder:
+    """Testo composto a pezzi e diviso in messaggi entro il limite di Telegram.
+
+    I pezzi si accumulano in liste e vengono uniti una volta sola; un pezzo
+    non viene mai diviso tra due messaggi, a meno che da solo superi il limite.
+    """
+
+    def __init__(self, text="", limit=TELEGRAM_MAX_MESSAGE_LENGTH):
+        self.limit = limit
+        self._chunks = []
+        self._parts = []
+        self._length = 0
+        if text:
+            self.add(text)
+
+    def add(self, text):
+        for start in range(0, len(text), self.limit):
+            part = text[start:start + self.limit]
+            if self._length + len(part) > self.limit:
+                self._flush()
+            self._parts.append(part)
+            self._length += len(part)
+        return self
+
+    def _flush(self):
+        if self._parts:
+            self._chunks.append("".join(self._parts))
+            self._parts = []
+            self._length = 0
+
+    def chunks(self):
+        self._flush()
+        return self._chunks
+
+
+async def reply_long(message, builder):
+    for chunk in builder.chunks():
+        await message.reply_text(chunk)
+
+
+# ── Tastiere a pagine ───────────────────────────────────────────
+# Tipo di tastiera -> (prefisso callback del pasto scelto, icona davanti all'etichetta)
+PLAN_KEYBOARDS = {
+    "copy": ("copy_meal", ""),
+    "edit": ("edit_meal", ""),
+    "del": ("del_meal", "❌ "),
+}
+
+
+async def plan_keyboard(user_id, kind, page=0):
+    """Una pagina di pasti come bottoni, con avanti/indietro; None se la pagina e' vuota."""
+    rows, has_next = await get_plan_page(user_id, page)
+    if not rows:
+        return None
+    prefix, icon = PLAN_KEYBOARDS[kind]
+    buttons = [
+        [InlineKeyboardButton(
+            f"{icon}{GIORNI_SHORT[day]} {meal_time} - {name}: {recipe[:25]}",
+            callback_data=f"{prefix}_{meal_id}",
+        )]
+        for meal_id, day, name, meal_time, recipe in rows
+    ]
+    nav = []
+    if page:
+        nav.append(InlineKeyboardButton("⬅ Indietro", callback_data=f"page_{kind}_{page - 1}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("Avanti ➡", callback_data=f"page_{kind}_{page + 1}"))
+    if nav:
+        buttons.append(nav)
+    return InlineKeyboardMarkup(buttons)
+
+
+async def plan_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    _, kind, page = query.data.split("_")
+    # Se nel frattempo la pagina si e' svuotata (pasti eliminati) si riparte dalla prima
+    markup = await plan_keyboard(query.from_user.id, kind, int(page)) or await plan_keyboard(query.from_user.id, kind)
+    if markup is None:
+        await query.edit_message_text("📋 Non hai piu' pasti nel piano.")
+        return
+    await query.edit_message_reply_markup(reply_markup=markup)
+
+
+async def edit_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await plan_page(update, context)
+    return EDIT_SELECT
 
 
 # ── Messaggi motivazionali ──────────────────────────────────────
@@ -125,6 +1871,39 @@ def get_motivational():
     return random.choice(FRASI_MOTIVAZIONALI)
 
 
+# ── Fine dei flussi ─────────────────────────────────────────────
+def end_flow(context, *flows):
+    """Rimuove da user_data le chiavi dei flussi indicati (tutti se nessuno) e chiude la conversazione."""
+    for flow in flows or FLOW_KEYS:
+        for key in FLOW_KEYS[flow]:
+            context.user_data.pop(key, None)
+    return ConversationHandler.END
+
+
+def flow_timeout(flow):
+    """Handler per lo stato TIMEOUT di una conversazione: pulisce il flusso e avvisa l'utente."""
+
+    async def timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        end_flow(context, flow)
+        if update.effective_message:
+            await update.effective_message.reply_text(
+                "⏰ Tempo scaduto, operazione annullata. Puoi ricominciare quando vuoi.",
+                reply_markup=ReplyKeyboardRemove(),
+            )
+
+    return TypeHandler(Update, timeout)
+
+
+def flow_cancel(flow):
+    """Fallback /annulla di una conversazione: chiude solo quella, gli altri flussi aperti restano intatti."""
+
+    async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await update.message.reply_text("❌ Operazione annullata.", reply_markup=ReplyKeyboardRemove())
+        return end_flow(context, flow)
+
+    return CommandHandler("annulla", cancel)
+
+
 # ── Comandi base ────────────────────────────────────────────────
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -136,12 +1915,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/oggi - Pasti di oggi\n"
         "/modifica_pasto - Modifica un pasto\n"
         "/copia_pasto - Copia un pasto su altri giorni\n"
+        "/copia_giorno - Copia un giorno intero (es. /copia_giorno lun mar-ven)\n"
+        "/scambia_giorni - Scambia due giorni (es. /scambia_giorni lun gio)\n"
+        "/svuota_giorno - Togli tutti i pasti di un giorno\n"
         "/elimina_pasto - Rimuovi un pasto\n\n"
         "📊 Tracking Progressi\n"
         "/progresso - Registra peso e misure\n"
-        "/storico - Vedi i tuoi progressi\n\n"
+        "/storico - Vedi i tuoi progressi\n"
+        "/analisi - Medie e andamento delle misure\n"
+        "/grafico - Grafico di peso e misure\n\n"
+        "🛒 Spesa\n"
+        "/spesa [giorni] - Lista della spesa dei prossimi giorni\n\n"
         "⚙ Impostazioni\n"
-        "/impostazioni - Configura check-in e reminder spesa\n\n"
+        "/impostazioni - Configura check-in, reminder spesa e fuso orario\n\n"
         "💡 Tip: Riceverai reminder prima di ogni pasto "
         "e la sera prima la lista della spesa per il giorno dopo!"
     )
@@ -156,9 +1942,17 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/oggi - Pasti di oggi\n"
         "/modifica_pasto - Modifica un pasto\n"
         "/copia_pasto - Copia pasto su altri giorni\n"
+        "/copia_giorno <da> <giorni> - Copia tutti i pasti di un giorno\n"
+        "/scambia_giorni <giorno> <giorno> - Scambia due giorni\n"
+        "/svuota_giorno <giorno> - Elimina i pasti di un giorno\n"
         "/elimina_pasto - Elimina un pasto\n"
         "/progresso - Registra peso e misure\n"
         "/storico - Storico progressi\n"
+        "/analisi [misura] [obiettivo] - Medie mobili, andamento e previsione (es. /analisi vita 80)\n"
+        "/grafico - Grafico dei progressi\n"
+        "/spesa [giorni] - Lista spesa sommata sui prossimi giorni\n"
+        "/esporta [csv|json] - Scarica pasti e progressi\n"
+        "/importa - Carica pasti e progressi da file\n"
         "/impostazioni - Impostazioni\n"
         "/motivami - Messaggio motivazionale\n"
         "/annulla - Annulla operazione\n"
@@ -287,24 +2081,33 @@ async def meal_reminder_custom(update: Update, context: ContextTypes.DEFAULT_TYP
 async def save_meal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     days = context.user_data["meal_days"]
     minutes = context.user_data["meal_reminder_minutes"]
+    meal_minute, reminder_minute = meal_minutes(context.user_data["meal_time"], minutes)
 
-    conn = get_db()
-    c = conn.cursor()
-    for day in days:
-        c.execute(
-            "INSERT INTO meals (user_id, day_of_week, meal_name, meal_time, recipe, reminder_minutes_before) "
-            "VALUES (?, ?, ?, ?, ?, ?)",
-            (
-                update.effective_user.id,
-                day,
-                context.user_data["meal_name"],
-                context.user_data["meal_time"],
-                context.user_data["meal_recipe"],
-                minutes,
-            ),
+    def insert_meals(c):
+        recipe_id = _acquire_recipe(
+            c, update.effective_user.id, context.user_data["meal_name"], context.user_data["meal_recipe"], len(days)
         )
-    conn.commit()
-    conn.close()
+        meal_ids = []
+        for day in days:
+            c.execute(
+                "INSERT INTO meals (user_id, day_of_week, recipe_id, meal_time, reminder_minutes_before, "
+                "meal_minute, reminder_minute) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    update.effective_user.id,
+                    day,
+                    recipe_id,
+                    context.user_data["meal_time"],
+                    minutes,
+                    meal_minute,
+                    reminder_minute,
+                ),
+            )
+            meal_ids.append((c.lastrowid, day))
+        _log_schedule_changes(c, [(meal_id, update.effective_user.id) for meal_id, _ in meal_ids])
+        return meal_ids
+
+    await schedule_meals([meal_id for meal_id, _ in await db.transaction(insert_meals)])
+    plan_cache.invalidate(update.effective_user.id)
 
     if minutes == -1:
         reminder_text = "alle 8:00 del giorno stesso"
@@ -324,20 +2127,12 @@ async def save_meal(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"{get_motivational()}",
         reply_markup=ReplyKeyboardRemove(),
     )
-    return ConversationHandler.END
+    return end_flow(context, "meal")
 
 
 # ── Vedi Pasti (settimana intera) ───────────────────────────────
 async def vedi_pasti(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT day_of_week, meal_name, meal_time, recipe FROM meals "
-        "WHERE user_id = ? ORDER BY day_of_week, meal_time",
-        (update.effective_user.id,),
-    )
-    rows = c.fetchall()
-    conn.close()
+    rows = await get_week_plan(update.effective_user.id)
 
     if not rows:
         await update.message.reply_text(
@@ -345,30 +2140,22 @@ async def vedi_pasti(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    text = "📋 Il tuo piano settimanale:\n\n"
-    current_day = -1
-    for day, name, meal_time, recipe in rows:
-        if day != current_day:
-            current_day = day
-            text += f"📅 {GIORNI[day]}\n"
-        text += f"  🕐 {meal_time} - {name}\n  └ {recipe}\n\n"
+    message = MessageBuilder("📋 Il tuo piano settimanale:\n\n")
+    # Un giorno e' un pezzo solo: il titolo non finisce mai in un messaggio diverso dai suoi pasti
+    for day, meals in groupby(rows, key=lambda row: row[1]):
+        message.add(
+            f"📅 {GIORNI[day]}\n"
+            + "".join(f"  🕐 {meal_time} - {name}\n  └ {recipe}\n\n" for _, _, name, meal_time, recipe in meals)
+        )
 
-    await update.message.reply_text(text)
+    await reply_long(update.message, message)
 
 
 # ── Pasti di oggi ───────────────────────────────────────────────
 async def oggi(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    current_day = datetime.now().weekday()
+    current_day = (await user_now(update.effective_user.id)).weekday()
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT meal_name, meal_time, recipe FROM meals "
-        "WHERE user_id = ? AND day_of_week = ? ORDER BY meal_time",
-        (update.effective_user.id, current_day),
-    )
-    rows = c.fetchall()
-    conn.close()
+    rows = [row[2:] for row in await get_week_plan(update.effective_user.id) if row[1] == current_day]
 
     if not rows:
         await update.message.reply_text(
@@ -377,163 +2164,267 @@ async def oggi(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    text = f"📋 Pasti di oggi ({GIORNI[current_day]}):\n\n"
+    message = MessageBuilder(f"📋 Pasti di oggi ({GIORNI[current_day]}):\n\n")
     for name, meal_time, recipe in rows:
-        text += f"🕐 {meal_time} - {name}\n└ {recipe}\n\n"
+        message.add(f"🕐 {meal_time} - {name}\n└ {recipe}\n\n")
 
-    text += f"\n{get_motivational()}"
-    await update.message.reply_text(text)
+    message.add(f"\n{get_motivational()}")
+    await reply_long(update.message, message)
 
 
 # ── Copia Pasto ─────────────────────────────────────────────────
 async def copia_pasto(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT id, day_of_week, meal_name, meal_time, recipe FROM meals "
-        "WHERE user_id = ? ORDER BY day_of_week, meal_time",
-        (update.effective_user.id,),
-    )
-    rows = c.fetchall()
-    conn.close()
+    markup = await plan_keyboard(update.effective_user.id, "copy")
 
-    if not rows:
+    if markup is None:
         await update.message.reply_text("Non hai pasti da copiare.")
         return
 
-    buttons = []
-    for meal_id, day, name, meal_time, recipe in rows:
-        label = f"{GIORNI_SHORT[day]} {meal_time} - {name}: {recipe[:25]}"
-        buttons.append([InlineKeyboardButton(label, callback_data=f"copy_meal_{meal_id}")])
-
-    await update.message.reply_text(
-        "📋 Quale pasto vuoi copiare?",
-        reply_markup=InlineKeyboardMarkup(buttons),
-    )
+    await update.message.reply_text("📋 Quale pasto vuoi copiare?", reply_markup=markup)
 
 
-async def copia_pasto_select(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    meal_id = int(query.data.replace("copy_meal_", ""))
-    context.user_data["copy_meal_id"] = meal_id
-
-    # Mostra giorni come bottoni inline (multi-select simulato)
+# Lo stato della selezione sta tutto nel callback_data: "cpd_<id pasto>_<maschera giorni>"
+# (bit i = giorno i), e "cpok_..." per confermare. Nessun dato lato server.
+@lru_cache(maxsize=1024)
+def copy_days_keyboard(meal_id, mask):
     buttons = []
     row = []
     for i, g in enumerate(GIORNI_SHORT):
-        row.append(InlineKeyboardButton(g, callback_data=f"copyday_{i}"))
+        check = "✓ " if mask >> i & 1 else ""
+        row.append(InlineKeyboardButton(f"{check}{g}", callback_data=f"cpd_{meal_id}_{mask ^ (1 << i)}"))
         if len(row) == 4:
             buttons.append(row)
             row = []
     if row:
         buttons.append(row)
-    buttons.append([InlineKeyboardButton("✅ Conferma", callback_data="copyday_done")])
+    buttons.append([InlineKeyboardButton("✅ Conferma", callback_data=f"cpok_{meal_id}_{mask}")])
+    return InlineKeyboardMarkup(buttons)
+
+
+def _parse_copy_data(data):
+    _, meal_id, mask = data.split("_")
+    return int(meal_id), int(mask) & 0x7F
+
+
+async def copia_pasto_select(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    meal_id = int(query.data.replace("copy_meal_", ""))
 
-    context.user_data["copy_days"] = []
     await query.edit_message_text(
         "📅 Su quali giorni vuoi copiarlo?\nClicca i giorni e poi Conferma.",
-        reply_markup=InlineKeyboardMarkup(buttons),
+        reply_markup=copy_days_keyboard(meal_id, 0),
+    )
+
+
+async def copia_pasto_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    meal_id, mask = _parse_copy_data(query.data)
+    await query.edit_message_reply_markup(reply_markup=copy_days_keyboard(meal_id, mask))
+
+
+async def copia_pasto_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    meal_id, mask = _parse_copy_data(query.data)
+    days = [d for d in range(7) if mask >> d & 1]
+    if not days:
+        await query.edit_message_text("❌ Non hai selezionato nessun giorno.")
+        return
+
+    user_id = query.from_user.id
+
+    def copy_meal(c):
+        c.execute(
+            "SELECT recipe_id, meal_time, reminder_minutes_before, meal_minute, reminder_minute "
+            "FROM meals WHERE id = ? AND user_id = ?",
+            (meal_id, user_id),
+        )
+        meal = c.fetchone()
+        copies = []
+        if meal:
+            for day in days:
+                c.execute(
+                    "INSERT INTO meals (user_id, day_of_week, recipe_id, meal_time, "
+                    "reminder_minutes_before, meal_minute, reminder_minute) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (user_id, day, *meal),
+                )
+                copies.append((c.lastrowid, user_id, day, meal[4]))
+            # Le copie condividono la ricetta dell'originale
+            c.execute("UPDATE recipes SET refcount = refcount + ? WHERE id = ?", (len(copies), meal[0]))
+        _log_schedule_changes(c, [(copy[0], user_id) for copy in copies])
+        return copies
+
+    await schedule_meals([copy[0] for copy in await db.transaction(copy_meal)])
+    plan_cache.invalidate(user_id)
+
+    giorni_label = ", ".join(GIORNI_SHORT[d] for d in days)
+    await query.edit_message_text(f"✅ Pasto copiato su: {giorni_label}!")
+
+
+# ── Operazioni su giorni interi ─────────────────────────────────
+def parse_days(args):
+    """Giorni indicati negli argomenti: 'lun', 'martedi', intervalli 'lun-ven' o 'tutti'.
+
+    Restituisce la lista ordinata senza doppioni, None se un argomento non e' valido.
+    """
+    names = [g.lower() for g in GIORNI_SHORT]
+    days = set()
+    for arg in args:
+        arg = arg.lower()
+        if arg == "tutti":
+            days.update(range(7))
+            continue
+        bounds = [part.strip()[:3] for part in arg.split("-")]
+        if len(bounds) > 2 or any(bound not in names for bound in bounds):
+            return None
+        first, last = names.index(bounds[0]), names.index(bounds[-1])
+        if last < first:
+            return None
+        days.update(range(first, last + 1))
+    return sorted(days)
+
+
+def _days_label(days):
+    return ", ".join(GIORNI_SHORT[d] for d in days)
+
+
+async def _apply_day_change(user_id, fn, *args):
+    """Esegue fn(cursor, user_id, *args) in una transazione e aggiorna calendario e cache una volta.
+
+    fn restituisce (pasti inseriti o spostati come (id, giorno, minuto reminder), id dei pasti tolti).
+    """
+    scheduled, removed = await db.transaction(fn, user_id, *args)
+    await schedule_meals([meal_id for meal_id, _, _ in scheduled])
+    for meal_id in removed:
+        reminder_wheel.remove(meal_id)
+    if scheduled or removed:
+        plan_cache.invalidate(user_id)
+    return scheduled, removed
+
+
+def _copy_day(c, user_id, source, targets):
+    # Un solo INSERT ... SELECT per tutti i giorni di destinazione; salta i pasti gia' presenti
+    values = ", ".join(["(?)"] * len(targets))
+    c.execute(
+        f"WITH targets (day) AS (VALUES {values}) "
+        "INSERT INTO meals (user_id, day_of_week, recipe_id, meal_time, reminder_minutes_before, "
+        "meal_minute, reminder_minute) "
+        "SELECT m.user_id, t.day, m.recipe_id, m.meal_time, m.reminder_minutes_before, m.meal_minute, m.reminder_minute "
+        "FROM meals m JOIN targets t "
+        "WHERE m.user_id = ? AND m.day_of_week = ? AND NOT EXISTS ("
+        "SELECT 1 FROM meals d WHERE d.user_id = m.user_id AND d.day_of_week = t.day "
+        "AND d.meal_time = m.meal_time AND d.recipe_id = m.recipe_id) "
+        "RETURNING id, day_of_week, reminder_minute, recipe_id",
+        (*targets, user_id, source),
+    )
+    rows = c.fetchall()
+    _retain_recipes(c, [row[3] for row in rows])
+    _log_schedule_changes(c, [(row[0], user_id) for row in rows])
+    return [row[:3] for row in rows], []
+
+
+def _clear_day(c, user_id, day):
+    c.execute("DELETE FROM meals WHERE user_id = ? AND day_of_week = ? RETURNING id, recipe_id", (user_id, day))
+    rows = c.fetchall()
+    _release_recipes(c, [row[1] for row in rows])
+    _log_schedule_changes(c, [(row[0], user_id) for row in rows])
+    return [], [row[0] for row in rows]
+
+
+def _swap_days(c, user_id, first, second):
+    c.execute(
+        "UPDATE meals SET day_of_week = CASE day_of_week WHEN ? THEN ? ELSE ? END "
+        "WHERE user_id = ? AND day_of_week IN (?, ?) RETURNING id, day_of_week, reminder_minute",
+        (first, second, first, user_id, first, second),
+    )
+    rows = c.fetchall()
+    _log_schedule_changes(c, [(row[0], user_id) for row in rows])
+    return rows, []
+
+
+async def copia_giorno(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    days = parse_days(context.args[:1])
+    targets = parse_days(context.args[1:])
+    # Si copia da un giorno solo: "lun-mer" o "tutti" come origine non hanno senso
+    if not days or len(days) != 1 or not targets:
+        await update.message.reply_text(
+            "Uso: /copia_giorno <giorno> <giorni di destinazione>\n"
+            "Esempi: /copia_giorno lun mar-ven, /copia_giorno sab dom"
+        )
+        return
+    source = days[0]
+    targets = [d for d in targets if d != source]
+    if not targets:
+        await update.message.reply_text("❌ Scegli giorni di destinazione diversi da quello di partenza.")
+        return
+
+    copied, _ = await _apply_day_change(update.effective_user.id, _copy_day, source, targets)
+    if not copied:
+        await update.message.reply_text(
+            f"Nessun pasto nuovo da copiare: {GIORNI[source]} e' vuoto o i pasti sono gia' presenti."
+        )
+        return
+    await update.message.reply_text(
+        f"✅ Copiati {len(copied)} pasti da {GIORNI[source]} su: {_days_label(targets)}!"
     )
 
 
-async def copia_pasto_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+async def svuota_giorno(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    days = parse_days(context.args)
+    if not days or len(days) != 1:
+        await update.message.reply_text("Uso: /svuota_giorno <giorno>  (es. /svuota_giorno mer)")
+        return
 
-    if query.data == "copyday_done":
-        days = context.user_data.get("copy_days", [])
-        if not days:
-            await query.edit_message_text("❌ Non hai selezionato nessun giorno.")
-            return
+    _, removed = await _apply_day_change(update.effective_user.id, _clear_day, days[0])
+    await update.message.reply_text(f"🗑 Eliminati {len(removed)} pasti di {GIORNI[days[0]]}.")
 
-        meal_id = context.user_data["copy_meal_id"]
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("SELECT user_id, meal_name, meal_time, recipe, reminder_minutes_before FROM meals WHERE id = ?", (meal_id,))
-        meal = c.fetchone()
-        if meal:
-            for day in days:
-                c.execute(
-                    "INSERT INTO meals (user_id, day_of_week, meal_name, meal_time, recipe, reminder_minutes_before) "
-                    "VALUES (?, ?, ?, ?, ?, ?)",
-                    (meal[0], day, meal[1], meal[2], meal[3], meal[4]),
-                )
-            conn.commit()
-        conn.close()
 
-        giorni_label = ", ".join(GIORNI_SHORT[d] for d in sorted(days))
-        await query.edit_message_text(f"✅ Pasto copiato su: {giorni_label}!")
+async def scambia_giorni(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    days = [parse_days([arg]) for arg in context.args]
+    if len(days) != 2 or not all(d and len(d) == 1 for d in days) or days[0] == days[1]:
+        await update.message.reply_text("Uso: /scambia_giorni <giorno> <giorno>  (es. /scambia_giorni lun gio)")
         return
+    first, second = days[0][0], days[1][0]
 
-    day_idx = int(query.data.replace("copyday_", ""))
-    copy_days = context.user_data.get("copy_days", [])
-    if day_idx in copy_days:
-        copy_days.remove(day_idx)
-    else:
-        copy_days.append(day_idx)
-    context.user_data["copy_days"] = copy_days
-
-    # Aggiorna bottoni con checkmark
-    buttons = []
-    row = []
-    for i, g in enumerate(GIORNI_SHORT):
-        check = "✓ " if i in copy_days else ""
-        row.append(InlineKeyboardButton(f"{check}{g}", callback_data=f"copyday_{i}"))
-        if len(row) == 4:
-            buttons.append(row)
-            row = []
-    if row:
-        buttons.append(row)
-    buttons.append([InlineKeyboardButton("✅ Conferma", callback_data="copyday_done")])
-
-    await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(buttons))
+    moved, _ = await _apply_day_change(update.effective_user.id, _swap_days, first, second)
+    await update.message.reply_text(
+        f"🔄 {GIORNI[first]} e {GIORNI[second]} scambiati ({len(moved)} pasti spostati)."
+    )
 
 
 # ── Modifica Pasto ──────────────────────────────────────────────
 async def modifica_pasto(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT id, day_of_week, meal_name, meal_time, recipe FROM meals "
-        "WHERE user_id = ? ORDER BY day_of_week, meal_time",
-        (update.effective_user.id,),
-    )
-    rows = c.fetchall()
-    conn.close()
+    markup = await plan_keyboard(update.effective_user.id, "edit")
 
-    if not rows:
+    if markup is None:
         await update.message.reply_text("Non hai pasti da modificare.")
         return ConversationHandler.END
 
-    buttons = []
-    for meal_id, day, name, meal_time, recipe in rows:
-        label = f"{GIORNI_SHORT[day]} {meal_time} - {name}: {recipe[:25]}"
-        buttons.append([InlineKeyboardButton(label, callback_data=f"edit_meal_{meal_id}")])
-
-    await update.message.reply_text(
-        "✏ Quale pasto vuoi modificare?",
-        reply_markup=InlineKeyboardMarkup(buttons),
-    )
+    await update.message.reply_text("✏ Quale pasto vuoi modificare?", reply_markup=markup)
     return EDIT_SELECT
 
 
+# "editfield_<id pasto>_<campo>": il pasto scelto viaggia nel callback_data
+@lru_cache(maxsize=1024)
+def edit_fields_keyboard(meal_id):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🍽 Nome pasto", callback_data=f"editfield_{meal_id}_meal_name")],
+        [InlineKeyboardButton("⏰ Orario", callback_data=f"editfield_{meal_id}_meal_time")],
+        [InlineKeyboardButton("🥘 Ricetta/piatto", callback_data=f"editfield_{meal_id}_recipe")],
+        [InlineKeyboardButton("🔔 Reminder", callback_data=f"editfield_{meal_id}_reminder")],
+    ])
+
+
 async def edit_select(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     meal_id = int(query.data.replace("edit_meal_", ""))
-    context.user_data["edit_meal_id"] = meal_id
-
-    buttons = [
-        [InlineKeyboardButton("🍽 Nome pasto", callback_data="editfield_meal_name")],
-        [InlineKeyboardButton("⏰ Orario", callback_data="editfield_meal_time")],
-        [InlineKeyboardButton("🥘 Ricetta/piatto", callback_data="editfield_recipe")],
-        [InlineKeyboardButton("🔔 Reminder", callback_data="editfield_reminder")],
-    ]
 
     await query.edit_message_text(
         "Cosa vuoi modificare?",
-        reply_markup=InlineKeyboardMarkup(buttons),
+        reply_markup=edit_fields_keyboard(meal_id),
     )
     return EDIT_FIELD
 
@@ -541,7 +2432,9 @@ async def edit_select(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def edit_field(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    field = query.data.replace("editfield_", "")
+    _, meal_id, field = query.data.split("_", 2)
+    # Il valore arriva come messaggio di testo: qui serve ricordare pasto e campo
+    context.user_data["edit_meal_id"] = int(meal_id)
     context.user_data["edit_field"] = field
 
     prompts = {
@@ -576,52 +2469,57 @@ async def edit_value(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Inserisci un numero tra 1 e 1440.")
             return EDIT_VALUE
 
-    # Mappa campo DB
+    # Mappa campo DB (nome e ricetta stanno in recipes)
     db_field_map = {
-        "meal_name": "meal_name",
         "meal_time": "meal_time",
-        "recipe": "recipe",
         "reminder": "reminder_minutes_before",
     }
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        f"UPDATE meals SET {db_field_map[field]} = ? WHERE id = ? AND user_id = ?",
-        (value, meal_id, update.effective_user.id),
-    )
-    conn.commit()
-    conn.close()
+    def update_meal(c):
+        if field in ("meal_name", "recipe"):
+            # Nome e ricetta sono condivisi: la modifica vale per tutti i giorni con la stessa ricetta
+            c.execute(
+                "SELECT r.id, r.meal_name, r.recipe FROM meals m JOIN recipes r ON r.id = m.recipe_id "
+                "WHERE m.id = ? AND m.user_id = ?",
+                (meal_id, update.effective_user.id),
+            )
+            row = c.fetchone()
+            if row:
+                content = {"meal_name": row[1], "recipe": row[2], field: value}
+                _update_recipe(c, update.effective_user.id, row[0], content["meal_name"], content["recipe"])
+            return False
+        c.execute(
+            f"UPDATE meals SET {db_field_map[field]} = ? WHERE id = ? AND user_id = ?",
+            (value, meal_id, update.effective_user.id),
+        )
+        if not c.rowcount:
+            return False
+        _log_schedule_changes(c, [(meal_id, update.effective_user.id)])
+        # Ricalcola le colonne in minuti del reminder
+        c.execute("SELECT meal_time, reminder_minutes_before FROM meals WHERE id = ?", (meal_id,))
+        c.execute(
+            "UPDATE meals SET meal_minute = ?, reminder_minute = ? WHERE id = ?",
+            (*meal_minutes(*c.fetchone()), meal_id),
+        )
+        return True
+
+    if await db.transaction(update_meal):
+        await schedule_meals([meal_id])
+    plan_cache.invalidate(update.effective_user.id)
 
     await update.message.reply_text("✅ Pasto aggiornato!")
-    return ConversationHandler.END
+    return end_flow(context, "edit")
 
 
 # ── Elimina Pasto ───────────────────────────────────────────────
 async def elimina_pasto(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT id, day_of_week, meal_name, meal_time, recipe FROM meals "
-        "WHERE user_id = ? ORDER BY day_of_week, meal_time",
-        (update.effective_user.id,),
-    )
-    rows = c.fetchall()
-    conn.close()
+    markup = await plan_keyboard(update.effective_user.id, "del")
 
-    if not rows:
+    if markup is None:
         await update.message.reply_text("Non hai pasti da eliminare.")
         return
 
-    buttons = []
-    for meal_id, day, name, meal_time, recipe in rows:
-        label = f"❌ {GIORNI_SHORT[day]} {meal_time} - {name}: {recipe[:25]}"
-        buttons.append([InlineKeyboardButton(label, callback_data=f"del_meal_{meal_id}")])
-
-    await update.message.reply_text(
-        "🗑 Quale pasto vuoi eliminare?",
-        reply_markup=InlineKeyboardMarkup(buttons),
-    )
+    await update.message.reply_text("🗑 Quale pasto vuoi eliminare?", reply_markup=markup)
 
 
 async def elimina_pasto_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -629,22 +2527,34 @@ async def elimina_pasto_callback(update: Update, context: ContextTypes.DEFAULT_T
     await query.answer()
     meal_id = int(query.data.replace("del_meal_", ""))
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("DELETE FROM meals WHERE id = ? AND user_id = ?", (meal_id, query.from_user.id))
-    conn.commit()
-    conn.close()
+    def delete_meal(c):
+        c.execute(
+            "DELETE FROM meals WHERE id = ? AND user_id = ? RETURNING recipe_id", (meal_id, query.from_user.id)
+        )
+        recipe_ids = [row[0] for row in c.fetchall()]
+        if recipe_ids:
+            _release_recipes(c, recipe_ids)
+            _log_schedule_changes(c, [(meal_id, query.from_user.id)])
+        return len(recipe_ids)
+
+    if await db.transaction(delete_meal):
+        reminder_wheel.remove(meal_id)
+        plan_cache.invalidate(query.from_user.id)
 
     await query.edit_message_text("✅ Pasto eliminato!")
 
 
 # ── Annulla ─────────────────────────────────────────────────────
-async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("❌ Operazione annullata.", reply_markup=ReplyKeyboardRemove())
-    return ConversationHandler.END
+# ── Registra Progressi ──────────────────────────────────────────
+def _record_progress(c, rows):
+    """Inserisce rilevazioni (user_id, date, weight, waist, hips, chest) e aggiorna progress_summary.
+
+    Da chiamare dentro db.transaction, cosi' riepilogo e storico restano allineati.
+    """
+    c.executemany("INSERT INTO progress (user_id, date, weight, waist, hips, chest) VALUES (?, ?, ?, ?, ?, ?)", rows)
+    c.executemany(_SQL_PROGRESS_SUMMARY, list(_progress_summary_params(rows)))
 
 
-# ── Registra Progressi ──────────────────────────────────────────
 async def progresso_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "📊 Registriamo i tuoi progressi!\n\n"
@@ -654,13 +2564,21 @@ async def progresso_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return PROGRESS_WEIGHT
 
 
+def parse_measure(value):
+    """Misura da testo o numero (accetta la virgola decimale): deve essere finita e positiva."""
+    number = float(str(value).strip().replace(",", "."))
+    if not (math.isfinite(number) and number > 0):
+        raise ValueError(f"misura {value!r} non valida")
+    return number
+
+
 async def progress_weight(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     if text.lower() == "/salta":
         context.user_data["progress_weight"] = None
     else:
         try:
-            context.user_data["progress_weight"] = float(text.replace(",", "."))
+            context.user_data["progress_weight"] = parse_measure(text)
         except ValueError:
             await update.message.reply_text("❌ Inserisci un numero valido (es. 75.5)")
             return PROGRESS_WEIGHT
@@ -675,7 +2593,7 @@ async def progress_waist(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["progress_waist"] = None
     else:
         try:
-            context.user_data["progress_waist"] = float(text.replace(",", "."))
+            context.user_data["progress_waist"] = parse_measure(text)
         except ValueError:
             await update.message.reply_text("❌ Inserisci un numero valido")
             return PROGRESS_WAIST
@@ -690,7 +2608,7 @@ async def progress_hips(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["progress_hips"] = None
     else:
         try:
-            context.user_data["progress_hips"] = float(text.replace(",", "."))
+            context.user_data["progress_hips"] = parse_measure(text)
         except ValueError:
             await update.message.reply_text("❌ Inserisci un numero valido")
             return PROGRESS_HIPS
@@ -705,26 +2623,29 @@ async def progress_chest(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["progress_chest"] = None
     else:
         try:
-            context.user_data["progress_chest"] = float(text.replace(",", "."))
+            context.user_data["progress_chest"] = parse_measure(text)
         except ValueError:
             await update.message.reply_text("❌ Inserisci un numero valido")
             return PROGRESS_CHEST
 
-    # Salva
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO progress (user_id, date, weight, waist, hips, chest) VALUES (?, ?, ?, ?, ?, ?)",
-        (
-            update.effective_user.id,
-            datetime.now().strftime("%Y-%m-%d"),
-            context.user_data.get("progress_weight"),
-            context.user_data.get("progress_waist"),
-            context.user_data.get("progress_hips"),
-            context.user_data.get("progress_chest"),
-        ),
+    # Salva e legge il peso precedente dal riepilogo, nella stessa transazione
+    row = (
+        update.effective_user.id,
+        (await user_now(update.effective_user.id)).strftime("%Y-%m-%d"),
+        *(context.user_data.get(f"progress_{metric}") for metric in PROGRESS_METRICS),
     )
-    conn.commit()
+
+    def save_progress(c):
+        _record_progress(c, [row])
+        c.execute(
+            "SELECT prev_value FROM progress_summary WHERE user_id = ? AND metric = 'weight'",
+            (update.effective_user.id,),
+        )
+        summary = c.fetchone()
+        return summary[0] if summary else None
+
+    prev_weight = await db.transaction(save_progress)
+    analytics_cache.invalidate(update.effective_user.id)
 
     # Riepilogo
     parts = ["✅ Progressi registrati!\n"]
@@ -741,36 +2662,24 @@ async def progress_chest(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if chest:
         parts.append(f"📏 Petto: {chest} cm")
 
-    # Confronto
-    c.execute(
-        "SELECT weight, waist, hips, chest FROM progress "
-        "WHERE user_id = ? ORDER BY date DESC, id DESC LIMIT 1 OFFSET 1",
-        (update.effective_user.id,),
-    )
-    prev = c.fetchone()
-    conn.close()
-
-    if prev and w and prev[0]:
-        diff = w - prev[0]
+    # Confronto con la rilevazione di peso precedente
+    if w and prev_weight:
+        diff = w - prev_weight
         emoji = "📉" if diff < 0 else "📈" if diff > 0 else "➡"
         parts.append(f"\n{emoji} Variazione peso: {diff:+.1f} kg rispetto all'ultima volta")
 
     parts.append(f"\n{get_motivational()}")
     await update.message.reply_text("\n".join(parts))
-    return ConversationHandler.END
+    return end_flow(context, "progress")
 
 
 # ── Storico ─────────────────────────────────────────────────────
 async def storico(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
+    rows = await db.fetchall(
         "SELECT date, weight, waist, hips, chest FROM progress "
         "WHERE user_id = ? ORDER BY date DESC LIMIT 12",
         (update.effective_user.id,),
     )
-    rows = c.fetchall()
-    conn.close()
 
     if not rows:
         await update.message.reply_text(
@@ -778,27 +2687,473 @@ async def storico(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    text = "📊 Storico progressi (ultime 12):\n\n"
+    parts = ["📊 Storico progressi (ultime 12):\n\n"]
     for date, weight, waist, hips, chest in rows:
-        text += f"📅 {date}\n"
+        parts.append(f"📅 {date}\n")
         if weight:
-            text += f"  ⚖ {weight:.1f} kg"
+            parts.append(f"  ⚖ {weight:.1f} kg")
         if waist:
-            text += f"  | Vita {waist:.0f}"
+            parts.append(f"  | Vita {waist:.0f}")
         if hips:
-            text += f"  | Fianchi {hips:.0f}"
+            parts.append(f"  | Fianchi {hips:.0f}")
         if chest:
-            text += f"  | Petto {chest:.0f}"
-        text += "\n"
+            parts.append(f"  | Petto {chest:.0f}")
+        parts.append("\n")
 
-    # Mostra trend se almeno 2 rilevazioni con peso
-    weights = [(r[0], r[1]) for r in rows if r[1]]
-    if len(weights) >= 2:
-        diff = weights[0][1] - weights[-1][1]
+    # Trend dalla prima rilevazione di peso, se ce ne sono almeno 2
+    summary = await db.fetchone(
+        "SELECT last_value, first_value, first_date, count FROM progress_summary "
+        "WHERE user_id = ? AND metric = 'weight'",
+        (update.effective_user.id,),
+    )
+    if summary and summary[3] >= 2:
+        diff = summary[0] - summary[1]
         emoji = "📉" if diff < 0 else "📈" if diff > 0 else "➡"
-        text += f"\n{emoji} Trend: {diff:+.1f} kg dal {weights[-1][0]}"
+        parts.append(f"\n{emoji} Trend: {diff:+.1f} kg dal {summary[2]}")
+
+    await update.message.reply_text("".join(parts))
+
+
+# ── Analisi progressi ───────────────────────────────────────────
+METRIC_LABELS = {
+    "weight": ("⚖ Peso", "kg"),
+    "waist": ("📏 Vita", "cm"),
+    "hips": ("📏 Fianchi", "cm"),
+    "chest": ("📏 Petto", "cm"),
+}
+# Nomi delle misure per /analisi <misura> <obiettivo>
+METRIC_NAMES = {"peso": "weight", "vita": "waist", "fianchi": "hips", "petto": "chest"}
+
+analytics_cache = UserCache(maxsize=ANALYTICS_CACHE_SIZE, ttl=ANALYTICS_CACHE_TTL)
+
+
+def analyze_progress(rows):
+    """Statistiche per misura da righe (date, weight, waist, hips, chest) in ordine di data.
+
+    Per ogni misura con dati: ultimo valore, medie degli ultimi 7 e 30 giorni e,
+    se ci sono almeno due giorni diversi negli ultimi ANALYTICS_TREND_DAYS,
+    la variazione settimanale stimata con i minimi quadrati e il valore della
+    retta all'ultimo giorno. I giorni sono numeri dal 1970-01-01.
+    """
+    days = np.array([row[0] for row in rows], dtype="datetime64[D]").astype(np.int64)
+    values = np.array([row[1:] for row in rows], dtype=float)  # None -> NaN
+    result = {}
+    for column, metric in enumerate(PROGRESS_METRICS):
+        measured = ~np.isnan(values[:, column])
+        x, y = days[measured], values[measured, column]
+        if not len(x):
+            continue
+        stats = {"last": float(y[-1]), "last_day": int(x[-1]), "count": len(x)}
+        for window in (7, 30):
+            stats[f"avg{window}"] = float(y[np.searchsorted(x, x[-1] - window + 1):].mean())
+        recent = np.searchsorted(x, x[-1] - ANALYTICS_TREND_DAYS + 1)
+        if x[recent] != x[-1]:
+            slope, intercept = np.polyfit(x[recent:] - x[-1], y[recent:], 1)
+            # Con valori costanti polyfit lascia un residuo di arrotondamento (~1e-14)
+            weekly = float(slope * 7)
+            stats["weekly"] = weekly if abs(weekly) >= ANALYTICS_FLAT_WEEKLY else 0.0
+            stats["fitted"] = float(intercept)
+        result[metric] = stats
+    return result
+
+
+def projected_day(stats, goal):
+    """Giorno (dal 1970-01-01) in cui la retta di tendenza raggiunge goal.
+
+    None se l'andamento e' stabile, va nella direzione opposta o ci arriverebbe
+    oltre ANALYTICS_MAX_PROJECTION_DAYS.
+    """
+    weekly = stats.get("weekly")
+    if weekly is None or abs(weekly) < ANALYTICS_FLAT_WEEKLY:
+        return None
+    days = (goal - stats["fitted"]) / (weekly / 7)
+    if not 0 <= days <= ANALYTICS_MAX_PROJECTION_DAYS:
+        return None
+    return stats["last_day"] + int(np.ceil(days))
+
+
+async def get_progress_analytics(user_id):
+    """Analisi dei progressi dell'utente: una query per tutto lo storico, poi cache fino al prossimo inserimento."""
+    stats = analytics_cache.get(user_id)
+    if stats is None:
+        invalidations = analytics_cache.invalidations
+        rows = await db.fetchall(
+            "SELECT date, weight, waist, hips, chest FROM progress WHERE user_id = ? ORDER BY date, id",
+            (user_id,),
+        )
+        stats = analyze_progress(rows) if rows else {}
+        analytics_cache.put(user_id, stats, invalidations)
+    return stats
+
+
+async def analisi(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # "/analisi 70" = obiettivo di peso, "/analisi vita 80" = obiettivo per un'altra misura
+    goal, target = None, "weight"
+    args = list(context.args)
+    if len(args) == 2 and args[0].lower() in METRIC_NAMES:
+        target = METRIC_NAMES[args.pop(0).lower()]
+    if args:
+        try:
+            if len(args) != 1:
+                raise ValueError
+            goal = float(args[0].replace(",", "."))
+        except ValueError:
+            await update.message.reply_text(
+                "Uso: /analisi [misura] [obiettivo]  (es. /analisi 70, /analisi vita 80)\n"
+                f"Misure: {', '.join(METRIC_NAMES)}"
+            )
+            return
+
+    stats = await get_progress_analytics(update.effective_user.id)
+    if not stats:
+        await update.message.reply_text("📊 Nessun dato registrato ancora.\nUsa /progresso per iniziare!")
+        return
+
+    parts = ["📈 Analisi dei progressi"]
+    for metric, (label, unit) in METRIC_LABELS.items():
+        s = stats.get(metric)
+        if s is None:
+            continue
+        parts.append(f"\n{label}: {s['last']:.1f} {unit} ({s['count']} rilevazioni)")
+        parts.append(f"  Media 7 giorni: {s['avg7']:.1f} | 30 giorni: {s['avg30']:.1f}")
+        if "weekly" in s:
+            parts.append(f"  Andamento: {s['weekly']:+.2f} {unit}/settimana (ultimi {ANALYTICS_TREND_DAYS} giorni)")
+
+    if goal is not None and target in stats:
+        label, unit = METRIC_LABELS[target]
+        day = projected_day(stats[target], goal)
+        if day is not None:
+            parts.append(f"\n🎯 {label} {goal:.1f} {unit}: previsto intorno al {np.datetime64(day, 'D')}")
+        else:
+            parts.append(f"\n🎯 {label} {goal:.1f} {unit}: con l'andamento attuale non e' prevedibile")
+    elif goal is not None:
+        parts.append(f"\n🎯 Nessuna rilevazione di {METRIC_LABELS[target][0]} per la previsione")
+
+    await update.message.reply_text("\n".join(parts))
+
+
+# ── Grafico progressi ───────────────────────────────────────────
+_chart_pool = None
+
+
+def chart_pool():
+    """Processi per il rendering dei grafici, creati al primo uso.
+
+    Avviati con "spawn": il processo del bot ha thread attivi (database, job)
+    e un fork potrebbe ereditarne i lock.
+    """
+    global _chart_pool
+    if _chart_pool is None:
+        _chart_pool = ProcessPoolExecutor(max_workers=CHART_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _chart_pool
+
+
+def render_chart(rows, path):
+    """Disegna peso e circonferenze da righe (date, weight, waist, hips, chest) e salva il PNG in path.
+
+    Gira in un processo del pool: matplotlib viene importato solo li'.
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    days = np.array([row[0] for row in rows], dtype="datetime64[D]")
+    values = np.array([row[1:] for row in rows], dtype=float)
+    fig, (top, bottom) = plt.subplots(2, 1, sharex=True, figsize=(8, 6), dpi=100)
+    for axis, columns in ((top, (0,)), (bottom, (1, 2, 3))):
+        for column in columns:
+            measured = ~np.isnan(values[:, column])
+            if measured.any():
+                label = METRIC_LABELS[PROGRESS_METRICS[column]][0].split()[-1]
+                axis.plot(days[measured], values[measured, column], marker=".", label=label)
+        axis.grid(alpha=0.3)
+        if axis.get_legend_handles_labels()[0]:
+            axis.legend(loc="best")
+    top.set_ylabel("kg")
+    bottom.set_ylabel("cm")
+    fig.autofmt_xdate()
+    fig.tight_layout()
+    # Scrive accanto e rinomina: chi legge non vede mai un file a meta'
+    partial = f"{path}.tmp"
+    fig.savefig(partial, format="png")
+    plt.close(fig)
+    os.replace(partial, path)
+
+
+async def grafico(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    # Il grafico dipende solo dall'ultima rilevazione: stessa rilevazione, stesso grafico
+    row = await db.fetchone(
+        "SELECT p.id, c.progress_id, c.file_id FROM progress p "
+        "LEFT JOIN progress_charts c ON c.user_id = p.user_id "
+        "WHERE p.user_id = ? ORDER BY p.id DESC LIMIT 1",
+        (user_id,),
+    )
+    if row is None:
+        await update.message.reply_text("📊 Nessun dato registrato ancora.\nUsa /progresso per iniziare!")
+        return
+    progress_id, sent_progress_id, file_id = row
+
+    if sent_progress_id == progress_id:
+        try:
+            await update.message.reply_photo(photo=file_id)
+            return
+        except BadRequest:
+            logger.warning(f"file_id del grafico di {user_id} non piu' valido, lo ricarico")
+
+    path = os.path.join(CHART_DIR, f"{user_id}_{progress_id}.png")
+    if not os.path.exists(path):
+        # Stessa query di /storico, in ordine cronologico
+        rows = await db.fetchall(
+            "SELECT date, weight, waist, hips, chest FROM progress WHERE user_id = ? ORDER BY date, id",
+            (user_id,),
+        )
+        os.makedirs(CHART_DIR, exist_ok=True)
+        await asyncio.get_running_loop().run_in_executor(chart_pool(), render_chart, rows, path)
+        # Il grafico inviato l'ultima volta non serve piu'; eventuali altri li toglie la pulizia notturna
+        if sent_progress_id is not None:
+            try:
+                os.unlink(os.path.join(CHART_DIR, f"{user_id}_{sent_progress_id}.png"))
+            except FileNotFoundError:
+                pass
+
+    with open(path, "rb") as f:
+        message = await update.message.reply_photo(photo=f, caption="📈 I tuoi progressi")
+    await db.execute(
+        "INSERT INTO progress_charts (user_id, progress_id, file_id) VALUES (?, ?, ?) "
+        "ON CONFLICT (user_id) DO UPDATE SET progress_id = excluded.progress_id, file_id = excluded.file_id",
+        (user_id, progress_id, message.photo[-1].file_id),
+    )
+
+
+# ── Esporta / Importa ───────────────────────────────────────────
+# Un solo file con pasti e progressi: "kind" dice di che riga si tratta.
+# CSV con tutte le colonne, oppure JSON Lines (un oggetto per riga).
+EXPORT_FIELDS = (
+    "kind", "user_id",
+    "day_of_week", "meal_time", "meal_name", "recipe", "reminder_minutes_before",
+    "date", "weight", "waist", "hips", "chest",
+)
+EXPORT_QUERIES = (
+    (
+        "meal",
+        ("user_id", "day_of_week", "meal_time", "meal_name", "recipe", "reminder_minutes_before"),
+        "SELECT m.user_id, m.day_of_week, m.meal_time, r.meal_name, r.recipe, m.reminder_minutes_before "
+        "FROM meals m JOIN recipes r ON r.id = m.recipe_id {where} ORDER BY m.user_id, m.day_of_week, m.meal_time, m.id",
+        "m.user_id",
+    ),
+    (
+        "progress",
+        ("user_id", "date", "weight", "waist", "hips", "chest"),
+        "SELECT user_id, date, weight, waist, hips, chest FROM progress {where} ORDER BY user_id, date, id",
+        "user_id",
+    ),
+)
+EXPORT_FORMATS = {"csv": ".csv", "json": ".jsonl"}
+
+
+def export_format(filename):
+    """Formato ('csv' o 'json') dedotto dall'estensione del file, None se sconosciuta."""
+    ext = os.path.splitext(filename or "")[1].lower()
+    if ext == ".csv":
+        return "csv"
+    if ext in (".json", ".jsonl"):
+        return "json"
+    return None
+
+
+def _export_records(conn, user_id=None):
+    """Righe da esportare come dict, lette a blocchi di EXPORT_BATCH_ROWS (tutti gli utenti se user_id e' None)."""
+    for kind, columns, sql, user_column in EXPORT_QUERIES:
+        where, params = ("", ()) if user_id is None else (f"WHERE {user_column} = ?", (user_id,))
+        cursor = conn.execute(sql.format(where=where), params)
+        while rows := cursor.fetchmany(EXPORT_BATCH_ROWS):
+            for row in rows:
+                yield {"kind": kind, **dict(zip(columns, row))}
+
+
+def _write_export(conn, path, fmt, user_id=None):
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        if fmt == "csv":
+            writer = csv.DictWriter(f, fieldnames=EXPORT_FIELDS)
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            def write(record):
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        for record in _export_records(conn, user_id):
+            write(record)
+            count += 1
+    return count
+
+
+async def export_to_file(path, fmt, user_id=None):
+    """Scrive l'esportazione su file senza tenerla in memoria; restituisce il numero di righe."""
+    return await db.read(_write_export, path, fmt, user_id)
+
+
+def _clean_meal(record):
+    day = int(record["day_of_week"])
+    if not 0 <= day <= 6:
+        raise ValueError(f"giorno {day} non valido (0-6)")
+    parsed = datetime.strptime(str(record["meal_time"]).strip(), "%H:%M")
+    name = str(record.get("meal_name") or "").strip()
+    recipe = str(record.get("recipe") or "").strip()
+    if not name or not recipe:
+        raise ValueError("nome del pasto o ricetta mancanti")
+    reminder = record.get("reminder_minutes_before")
+    reminder = 120 if reminder in (None, "") else int(reminder)
+    if reminder != -1 and not 1 <= reminder <= 1440:
+        raise ValueError(f"reminder {reminder} non valido (1-1440 o -1)")
+    return day, f"{parsed.hour:02d}:{parsed.minute:02d}", name, recipe, reminder
+
+
+def _clean_progress(record):
+    date = datetime.strptime(str(record["date"]).strip(), "%Y-%m-%d").strftime("%Y-%m-%d")
+    values = [
+        None if record.get(field) in (None, "") else parse_measure(record[field])
+        for field in PROGRESS_METRICS
+    ]
+    if all(value is None for value in values):
+        raise ValueError("nessuna misura")
+    return (date, *values)
+
+
+def _insert_meals(c, rows):
+    # Una ricetta per contenuto, poi tutti i pasti del blocco con un solo executemany
+    recipe_ids = {
+        key: _acquire_recipe(c, *key, count)
+        for key, count in Counter((owner, name, recipe) for owner, _, _, name, recipe, _ in rows).items()
+    }
+    c.executemany(
+        "INSERT INTO meals (user_id, day_of_week, recipe_id, meal_time, reminder_minutes_before, "
+        "meal_minute, reminder_minute) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (owner, day, recipe_ids[owner, name, recipe], meal_time, reminder, *meal_minutes(meal_time, reminder))
+            for owner, day, meal_time, name, recipe, reminder in rows
+        ],
+    )
+
+
+def _read_import(c, path, fmt, user_id=None):
+    """Legge e valida tutto il file su un thread di lettura: una riga non valida annulla l'import
+    prima di toccare lo scrittore.
+
+    Se user_id e' indicato tutte le righe vanno a quell'utente, altrimenti conta la colonna user_id.
+    Restituisce (pasti, progressi) gia' pronti per l'inserimento.
+    """
+    meals, progress = [], []
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        records = csv.DictReader(f) if fmt == "csv" else f
+        for number, record in enumerate(records, start=1):
+            try:
+                if fmt != "csv":
+                    if not record.strip():
+                        continue
+                    record = json.loads(record)
+                    if not isinstance(record, dict):
+                        raise ValueError("serve un oggetto JSON")
+                owner = user_id if user_id is not None else int(record["user_id"])
+                kind = record.get("kind")
+                if kind == "meal":
+                    meals.append((owner, *_clean_meal(record)))
+                elif kind == "progress":
+                    progress.append((owner, *_clean_progress(record)))
+                else:
+                    raise ValueError(f"tipo {kind!r} sconosciuto")
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"riga {number}: {e}") from None
+    return meals, progress
+
+
+def _import_rows(c, meals, progress):
+    """Inserisce le righe gia' validate in una sola transazione, a blocchi di IMPORT_BATCH_ROWS.
+
+    Restituisce gli id dei pasti inseriti.
+    """
+    c.execute("SELECT COALESCE(MAX(id), 0) FROM meals")
+    last_meal_id = c.fetchone()[0]
+    for start in range(0, len(meals), IMPORT_BATCH_ROWS):
+        _insert_meals(c, meals[start:start + IMPORT_BATCH_ROWS])
+    for start in range(0, len(progress), IMPORT_BATCH_ROWS):
+        _record_progress(c, progress[start:start + IMPORT_BATCH_ROWS])
+
+    # I pasti nuovi sono quelli con id oltre il massimo di prima (unico scrittore, AUTOINCREMENT)
+    c.execute(
+        "INSERT INTO schedule_changes (meal_id, user_id, changed_at) SELECT id, user_id, ? FROM meals WHERE id > ?",
+        (datetime.now().timestamp(), last_meal_id),
+    )
+    c.execute("SELECT id FROM meals WHERE id > ?", (last_meal_id,))
+    return [row[0] for row in c.fetchall()]
+
+
+async def import_from_file(path, fmt, user_id=None):
+    meals, progress = await db.read(_read_import, path, fmt, user_id)
+    meal_ids = await db.transaction(_import_rows, meals, progress)
+    await schedule_meals(meal_ids)
+    return len(meals), len(progress)
+
+
+async def esporta(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    fmt = context.args[0].lower() if context.args else "csv"
+    if fmt not in EXPORT_FORMATS:
+        await update.message.reply_text("Uso: /esporta [csv|json]")
+        return
+
+    fd, path = tempfile.mkstemp(suffix=EXPORT_FORMATS[fmt])
+    os.close(fd)
+    try:
+        count = await export_to_file(path, fmt, update.effective_user.id)
+        if not count:
+            await update.message.reply_text("📭 Non hai ancora pasti o progressi da esportare.")
+            return
+        with open(path, "rb") as f:
+            await update.message.reply_document(
+                document=f,
+                filename=f"diet_bot_{datetime.now():%Y-%m-%d}{EXPORT_FORMATS[fmt]}",
+                caption=f"📦 {count} righe esportate. Puoi ricaricarle con /importa.",
+            )
+    finally:
+        os.unlink(path)
+
+
+async def importa(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "📥 Mandami il file CSV o JSON creato con /esporta "
+        f"(massimo {IMPORT_MAX_BYTES // (1024 * 1024)} MB).\n"
+        "I pasti e i progressi verranno aggiunti a quelli che hai gia'.\n\n"
+        "/annulla per annullare."
+    )
+    return IMPORT_FILE
+
 
-    await update.message.reply_text(text)
+async def import_file_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    document = update.message.document
+    fmt = export_format(document.file_name)
+    if fmt is None:
+        await update.message.reply_text("❌ Serve un file .csv o .json/.jsonl. Riprova o /annulla.")
+        return IMPORT_FILE
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await update.message.reply_text("❌ File troppo grande. Riprova o /annulla.")
+        return IMPORT_FILE
+
+    fd, path = tempfile.mkstemp(suffix=EXPORT_FORMATS[fmt])
+    os.close(fd)
+    try:
+        await (await document.get_file()).download_to_drive(path)
+        meals, progress = await import_from_file(path, fmt, update.effective_user.id)
+    except (ValueError, UnicodeDecodeError, csv.Error, sqlite3.IntegrityError) as e:
+        await update.message.reply_text(f"❌ File non valido, nulla e' stato importato.\n{e}\n\nRiprova o /annulla.")
+        return IMPORT_FILE
+    finally:
+        os.unlink(path)
+
+    plan_cache.invalidate(update.effective_user.id)
+    analytics_cache.invalidate(update.effective_user.id)
+    await update.message.reply_text(f"✅ Importati {meals} pasti e {progress} rilevazioni!")
+    return ConversationHandler.END
 
 
 # ── Impostazioni ────────────────────────────────────────────────
@@ -843,14 +3198,50 @@ async def settings_grocery_time(update: Update, context: ContextTypes.DEFAULT_TY
             await update.message.reply_text("❌ Formato non valido. Scrivi come HH:MM (es. 20:00)")
             return SETTINGS_GROCERY_TIME
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "INSERT OR REPLACE INTO user_settings (user_id, weekly_checkin_day, grocery_reminder_time) VALUES (?, ?, ?)",
-        (update.effective_user.id, context.user_data["settings_checkin_day"], grocery_time),
+    context.user_data["settings_grocery_time"] = grocery_time
+
+    keyboard = [TIMEZONE_CHOICES[i:i + 2] for i in range(0, len(TIMEZONE_CHOICES), 2)]
+    await update.message.reply_text(
+        "🌍 In che fuso orario sei?\n"
+        "Scegli dalla lista o scrivi il nome (es. Europe/Berlin).\n\n"
+        f"Scrivi /salta per usare {DEFAULT_TIMEZONE}.",
+        reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True),
     )
-    conn.commit()
-    conn.close()
+    return SETTINGS_TIMEZONE
+
+
+async def settings_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    zone = None
+    if text.lower() != "/salta":
+        try:
+            zone = get_zone(text).key
+        except ValueError:
+            await update.message.reply_text("❌ Fuso orario non riconosciuto. Scrivilo come Europe/Rome.")
+            return SETTINGS_TIMEZONE
+
+    user_id = update.effective_user.id
+    grocery_time = context.user_data["settings_grocery_time"]
+
+    def save_settings(c):
+        c.execute(
+            "INSERT OR REPLACE INTO user_settings "
+            "(user_id, weekly_checkin_day, grocery_reminder_time, grocery_minute, timezone) VALUES (?, ?, ?, ?, ?)",
+            (
+                user_id,
+                context.user_data["settings_checkin_day"],
+                grocery_time,
+                parse_minute(grocery_time) if grocery_time else None,
+                zone,
+            ),
+        )
+        # Col fuso cambiano le caselle di tutti i pasti dell'utente
+        c.execute("SELECT id FROM meals WHERE user_id = ?", (user_id,))
+        meal_ids = [row[0] for row in c.fetchall()]
+        _log_schedule_changes(c, [(meal_id, user_id) for meal_id in meal_ids])
+        return meal_ids
+
+    await schedule_meals(await db.transaction(save_settings))
 
     day_name = GIORNI[context.user_data["settings_checkin_day"]]
     grocery_msg = f"🛒 Reminder spesa: ogni sera alle {grocery_time}" if grocery_time else "🛒 Reminder spesa: disattivato"
@@ -858,155 +3249,355 @@ async def settings_grocery_time(update: Update, context: ContextTypes.DEFAULT_TY
     await update.message.reply_text(
         f"✅ Impostazioni salvate!\n\n"
         f"📊 Check-in settimanale: ogni {day_name} alle 09:00\n"
-        f"{grocery_msg}",
+        f"{grocery_msg}\n"
+        f"🌍 Fuso orario: {zone or DEFAULT_TIMEZONE}",
         reply_markup=ReplyKeyboardRemove(),
     )
-    return ConversationHandler.END
+    return end_flow(context, "settings")
 
 
 # ── Job schedulati ──────────────────────────────────────────────
+def _claim_reminders(c, kind, keys):
+    """Registra i reminder (ref_id, data) come inviati e restituisce i ref_id non ancora registrati.
+
+    La chiave primaria del registro garantisce che un reminder parta una sola
+    volta, anche con recuperi ripetuti o piu' istanze del bot in parallelo.
+    """
+    sent_at = datetime.now().isoformat(timespec="seconds")
+    claimed = []
+    for ref_id, date in keys:
+        c.execute(
+            "INSERT OR IGNORE INTO sent_reminders (kind, ref_id, date, sent_at) VALUES (?, ?, ?, ?)",
+            (kind, ref_id, date, sent_at),
+        )
+        if c.rowcount:
+            claimed.append(ref_id)
+    return claimed
+
+
 async def send_meal_reminders(context: ContextTypes.DEFAULT_TYPE):
-    """Eseguito ogni 5 minuti. Controlla reminder pasti."""
-    now = datetime.now()
-    current_day = now.weekday()
+    """Eseguito ogni minuto. Invia i reminder scaduti nella timing wheel e non ancora inviati."""
+    due = reminder_wheel.due(utc_now())
+    if not due:
+        return
+    meal_ids = await db.transaction(_claim_reminders, "meal", due)
+    if not meal_ids:
+        return
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT user_id, meal_name, meal_time, recipe, reminder_minutes_before "
-        "FROM meals WHERE day_of_week = ?",
-        (current_day,),
+    placeholders = ", ".join("?" * len(meal_ids))
+    meals = await db.fetchall(
+        "SELECT m.user_id, r.meal_name, m.meal_time, r.recipe FROM meals m JOIN recipes r ON r.id = m.recipe_id "
+        f"WHERE m.id IN ({placeholders})",
+        meal_ids,
     )
-    meals = c.fetchall()
-    conn.close()
 
-    for user_id, meal_name, meal_time, recipe, reminder_minutes in meals:
-        meal_dt = datetime.strptime(meal_time, "%H:%M").replace(
-            year=now.year, month=now.month, day=now.day
+    for user_id, meal_name, meal_time, recipe in meals:
+        outbox.put(
+            user_id,
+            f"🔔 Reminder: {meal_name} alle {meal_time}!\n\n"
+            f"🥘 Devi preparare:\n{recipe}\n\n"
+            f"{get_motivational()}",
+            PRIORITY_MEAL,
+            "reminder pasti",
         )
 
-        if reminder_minutes == -1:
-            reminder_dt = meal_dt.replace(hour=8, minute=0)
-        else:
-            reminder_dt = meal_dt - timedelta(minutes=reminder_minutes)
-
-        diff_minutes = (now - reminder_dt).total_seconds() / 60
-        if 0 <= diff_minutes < 5:
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=(
-                        f"🔔 Reminder: {meal_name} alle {meal_time}!\n\n"
-                        f"🥘 Devi preparare:\n{recipe}\n\n"
-                        f"{get_motivational()}"
-                    ),
-                )
-            except Exception as e:
-                logger.error(f"Errore invio reminder a {user_id}: {e}")
-
 
 async def send_grocery_reminder(context: ContextTypes.DEFAULT_TYPE):
-    """Eseguito ogni 5 minuti. Manda lista spesa per domani."""
-    now = datetime.now()
-    tomorrow_day = (now.weekday() + 1) % 7
+    """Manda la lista spesa per domani, recuperando quelle perse negli ultimi minuti."""
+    if not shards.owned:
+        return
+    shard_condition, shard_params = shards.sql_filter("s.user_id")
+    cte, cte_params = zones_cte(await zone_clocks(utc_now()))
+
+    # Una sola query per tutti i fusi: utenti il cui orario locale e' passato da poco
+    # e che non hanno ancora ricevuto la lista di oggi, uniti ai pasti di domani
+    rows = await db.fetchall(
+        f"{cte}SELECT s.user_id, z.date, (z.day + 1) % 7, r.hash, r.recipe, i.ingredients "
+        "FROM zones z JOIN user_settings s ON COALESCE(s.timezone, ?) = z.name "
+        "AND s.grocery_minute > z.minute - ? AND s.grocery_minute <= z.minute "
+        "JOIN meals m ON m.user_id = s.user_id AND m.day_of_week = (z.day + 1) % 7 "
+        "JOIN recipes r ON r.id = m.recipe_id LEFT JOIN recipe_ingredients i ON i.hash = r.hash "
+        "WHERE NOT EXISTS (SELECT 1 FROM sent_reminders r "
+        f"WHERE r.kind = 'grocery' AND r.ref_id = s.user_id AND r.date = z.date) AND {shard_condition} "
+        "ORDER BY s.user_id",
+        (*cte_params, DEFAULT_TIMEZONE, REMINDER_GRACE_MINUTES, *shard_params),
+    )
+    if not rows:
+        return
+    keys = {row[0]: row[1] for row in rows}
+    claimed = set(await db.transaction(_claim_reminders, "grocery", list(keys.items())))
+    rows = [row for row in rows if row[0] in claimed]
+    # Ingredienti gia' estratti dalla tabella; solo le ricette nuove vengono analizzate
+    ingredients = await recipe_ingredients([row[3:] for row in rows])
 
-    conn = get_db()
-    c = conn.cursor()
+    for user_id, group in groupby(zip(rows, ingredients), key=lambda pair: pair[0][0]):
+        group = list(group)
+        tomorrow_day = group[0][0][2]
+        message = MessageBuilder(f"🛒 Spesa per domani ({GIORNI[tomorrow_day]})!\n\n")
+        message.add("Ecco cosa ti serve:\n\n")
+        for line in grocery_lines((parsed, 1) for _, parsed in group):
+            message.add(line)
+        message.add("\nControlla di avere tutto! 💪")
+        for chunk in message.chunks():
+            outbox.put(user_id, chunk, PRIORITY_GROCERY, "lista spesa")
 
-    # Trova utenti con grocery reminder attivo
-    c.execute("SELECT user_id, grocery_reminder_time FROM user_settings WHERE grocery_reminder_time IS NOT NULL")
-    users = c.fetchall()
 
-    for user_id, grocery_time in users:
-        if not grocery_time:
-            continue
-        try:
-            reminder_dt = datetime.strptime(grocery_time, "%H:%M").replace(
-                year=now.year, month=now.month, day=now.day
-            )
-        except ValueError:
-            continue
+async def _due_zone_clocks(minute):
+    """Fusi in cui l'ora locale `minute` e' passata da meno di REMINDER_GRACE_MINUTES."""
+    return [clock for clock in await zone_clocks(utc_now()) if minute <= clock[3] < minute + REMINDER_GRACE_MINUTES]
 
-        diff_minutes = (now - reminder_dt).total_seconds() / 60
-        if 0 <= diff_minutes < 5:
-            # Prendi i pasti di domani
-            c.execute(
-                "SELECT meal_name, meal_time, recipe FROM meals "
-                "WHERE user_id = ? AND day_of_week = ? ORDER BY meal_time",
-                (user_id, tomorrow_day),
-            )
-            meals = c.fetchall()
 
-            if meals:
-                text = f"🛒 Spesa per domani ({GIORNI[tomorrow_day]})!\n\n"
-                text += "Ecco cosa devi preparare domani:\n\n"
-                for name, meal_time, recipe in meals:
-                    text += f"🕐 {meal_time} - {name}\n└ {recipe}\n\n"
-                text += "Controlla di avere tutto! 💪"
+async def send_weekly_checkin(context: ContextTypes.DEFAULT_TYPE):
+    """Eseguito a intervalli. Check-in alle 9:00 locali del giorno scelto da ogni utente."""
+    if not shards.owned:
+        return
+    clocks = await _due_zone_clocks(CHECKIN_MINUTE)
+    if not clocks:
+        return
+    shard_condition, shard_params = shards.sql_filter("s.user_id")
+    cte, cte_params = zones_cte(clocks)
+
+    keys = await db.fetchall(
+        f"{cte}SELECT s.user_id, z.date FROM zones z JOIN user_settings s "
+        "ON COALESCE(s.timezone, ?) = z.name AND s.weekly_checkin_day = z.day "
+        f"WHERE {shard_condition}",
+        (*cte_params, DEFAULT_TIMEZONE, *shard_params),
+    )
+    if not keys:
+        return
 
-                try:
-                    await context.bot.send_message(chat_id=user_id, text=text)
-                except Exception as e:
-                    logger.error(f"Errore invio spesa a {user_id}: {e}")
+    for user_id in await db.transaction(_claim_reminders, "checkin", keys):
+        outbox.put(
+            user_id,
+            f"📊 E' il giorno del check-in settimanale!\n\n"
+            f"Come stanno andando i progressi?\n"
+            f"Usa /progresso per registrare peso e misure.\n\n"
+            f"{get_motivational()}",
+            PRIORITY_CHECKIN,
+            "check-in",
+        )
 
-    conn.close()
 
+async def send_random_motivation(context: ContextTypes.DEFAULT_TYPE):
+    """Eseguito a intervalli. Messaggio motivazionale random alle 10:00 e alle 15:00 locali."""
+    if not shards.owned:
+        return
+    shard_condition, shard_params = shards.sql_filter("m.user_id")
+    for minute in MOTIVATION_MINUTES:
+        clocks = await _due_zone_clocks(minute)
+        if not clocks:
+            continue
+        cte, cte_params = zones_cte(clocks)
+        keys = await db.fetchall(
+            f"{cte}SELECT DISTINCT m.user_id, z.date FROM meals m "
+            "LEFT JOIN user_settings s ON s.user_id = m.user_id JOIN zones z ON z.name = COALESCE(s.timezone, ?) "
+            f"WHERE {shard_condition}",
+            (*cte_params, DEFAULT_TIMEZONE, *shard_params),
+        )
+        if not keys:
+            continue
+        for user_id in await db.transaction(_claim_reminders, f"motivation_{minute // 60}", keys):
+            outbox.put(user_id, f"✨ Messaggio del giorno:\n\n{get_motivational()}", PRIORITY_MOTIVATION, "motivazione")
 
-async def send_weekly_checkin(context: ContextTypes.DEFAULT_TYPE):
-    """Eseguito ogni giorno alle 9:00."""
-    now = datetime.now()
-    current_day = now.weekday()
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT user_id FROM user_settings WHERE weekly_checkin_day = ?",
-        (current_day,),
+async def prune_sent_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """Eseguito ogni notte dal leader. Pulisce registro dei reminder, log delle modifiche, ingredienti e grafici orfani."""
+    if not shards.is_leader:
+        return
+    cutoff = datetime.now() - timedelta(days=SENT_REMINDERS_KEEP_DAYS)
+    await db.execute("DELETE FROM sent_reminders WHERE date < ?", (cutoff.strftime("%Y-%m-%d"),))
+    # I worker leggono il log ogni pochi secondi: un giorno di storico basta e avanza
+    await db.execute(
+        "DELETE FROM schedule_changes WHERE changed_at < ?",
+        ((datetime.now() - timedelta(days=1)).timestamp(),),
     )
-    users = c.fetchall()
-    conn.close()
+    # Ingredienti di ricette cancellate o cambiate
+    await db.execute("DELETE FROM recipe_ingredients WHERE hash NOT IN (SELECT hash FROM recipes)")
+    await prune_charts()
 
-    for (user_id,) in users:
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=(
-                    f"📊 E' il giorno del check-in settimanale!\n\n"
-                    f"Come stanno andando i progressi?\n"
-                    f"Usa /progresso per registrare peso e misure.\n\n"
-                    f"{get_motivational()}"
-                ),
-            )
-        except Exception as e:
-            logger.error(f"Errore invio check-in a {user_id}: {e}")
 
+async def prune_charts():
+    """Toglie dalla cartella dei grafici i PNG che non sono l'ultimo grafico inviato del loro utente."""
+    if not os.path.isdir(CHART_DIR):
+        return
+    current = {f"{user_id}_{progress_id}.png" for user_id, progress_id in
+               await db.fetchall("SELECT user_id, progress_id FROM progress_charts")}
+    for name in os.listdir(CHART_DIR):
+        if name.endswith(".png") and name not in current:
+            os.unlink(os.path.join(CHART_DIR, name))
+
+
+async def evict_user_data(context: ContextTypes.DEFAULT_TYPE):
+    """Toglie dalla memoria lo user_data degli utenti inattivi: resta su database e si ricarica al prossimo update."""
+    app = context.application
+    persistence = app.persistence
+    # Prima si scrivono le modifiche in sospeso, cosi' quasi tutti i candidati risultano salvati
+    await app.update_persistence()
+    users = persistence.idle_users(USER_DATA_IDLE_SECONDS, USER_DATA_MAX_USERS)
+    # Voci vuote create da PTB per utenti che non hanno mai attivato un handler
+    users.extend(user_id for user_id, data in app.user_data.items() if not data and not persistence.tracks(user_id))
+    evicted = [user_id for user_id in users if persistence.evict(user_id, app.user_data.get(user_id))]
+    if not evicted:
+        return
+    for user_id in evicted:
+        app.drop_user_data(user_id)
+    await app.update_persistence()
+    logger.info(f"user_data: {len(evicted)} utenti tolti dalla memoria, {len(app.user_data)} restano")
+
+
+async def log_metrics(context: ContextTypes.DEFAULT_TYPE):
+    """Scrive nel log le metriche interne, per dimensionare cache e code."""
+    logger.info(f"Metriche cache piani: {plan_cache.stats()}")
+    logger.info(f"Metriche cache analisi: {analytics_cache.stats()}")
+    logger.info(
+        f"Metriche coda invii: {len(outbox)} in coda, {outbox.enqueued} accodati, "
+        f"{outbox.coalesced} accorpati - {broadcaster.totals}"
+    )
+    for stats in outbox.stats.values():
+        logger.info(f"Metriche invii - {stats}")
+    user_data = context.application.user_data
+    logger.info(
+        f"Metriche user_data: {len(user_data)} utenti in memoria ({context.application.persistence.active_users} attivi), "
+        f"{sum(map(len, user_data.values()))} chiavi"
+    )
 
-async def send_random_motivation(context: ContextTypes.DEFAULT_TYPE):
-    """Invia un messaggio motivazionale random 2 volte al giorno."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT DISTINCT user_id FROM meals")
-    users = c.fetchall()
-    conn.close()
 
-    for (user_id,) in users:
+# ── Elaborazione update ─────────────────────────────────────────
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Elabora fino a `workers` update in parallelo.
+
+    Gli update dello stesso utente (o della stessa chat, se manca l'utente)
+    passano da un lock dedicato e restano quindi in ordine: le conversazioni
+    leggono e scrivono context.user_data un passo alla volta.
+
+    Il limite di PTB viene preso prima di do_process_update, quindi anche da
+    chi aspetta il lock del proprio utente: qui e' praticamente illimitato e i
+    posti veri si prendono solo dopo il lock, cosi' un utente che manda molti
+    update di fila non occupa i posti degli altri.
+    """
+
+    def __init__(self, workers):
+        super().__init__(sys.maxsize)
+        self._workers = asyncio.Semaphore(workers)
+        self._locks = {}  # chiave -> [lock, update in attesa o in corso]
+
+    @staticmethod
+    def _key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user is not None:
+            return ("user", update.effective_user.id)
+        if update.effective_chat is not None:
+            return ("chat", update.effective_chat.id)
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._key(update)
+        if key is None:
+            async with self._workers:
+                await coroutine
+            return
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
         try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"✨ Messaggio del giorno:\n\n{get_motivational()}",
-            )
-        except Exception as e:
-            logger.error(f"Errore invio motivazione a {user_id}: {e}")
+            async with entry[0], self._workers:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
 
 
 # ── Main ────────────────────────────────────────────────────────
+async def post_init(app: Application):
+    await load_reminder_wheel()
+    outbox.start(app.bot)
+
+
+async def post_stop(app: Application):
+    # Il bot e' ancora connesso: svuota la coda dei messaggi prima di chiudere
+    await outbox.stop()
+
+
+async def post_shutdown(app: Application):
+    if _chart_pool is not None:
+        _chart_pool.shutdown(wait=True)
+    await db.close()
+
+
+async def run_worker(app: Application):
+    """Modalita' worker: nessun update da Telegram, solo i job degli shard posseduti."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await app.initialize()
+    await post_init(app)
+    await app.start()
+    try:
+        await stop.wait()
+    finally:
+        await app.stop()
+        await post_stop(app)
+        await app.shutdown()
+        await post_shutdown(app)
+
+
+def run(app: Application):
+    """Avvia il bot in polling, via webhook o come worker; avvio e chiusura passano dagli stessi hook."""
+    if BOT_MODE == "polling":
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
+        return
+    if BOT_MODE == "worker":
+        asyncio.run(run_worker(app))
+        return
+    if BOT_MODE != "webhook":
+        raise SystemExit(f"BOT_MODE non valido: {BOT_MODE!r} (usa 'polling', 'webhook' o 'worker')")
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise SystemExit("In modalita' webhook servono WEBHOOK_URL e WEBHOOK_SECRET")
+
+    # Il server HTTP di PTB rifiuta le richieste senza l'header X-Telegram-Bot-Api-Secret-Token corretto
+    app.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+    )
+
+
 def main():
     init_db()
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_WORKERS))
+        .persistence(SQLitePersistence(db))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if BOT_MODE == "worker":
+        builder.updater(None)
+    app = builder.build()
 
     # Conversation: Aggiungi Pasto
     meal_conv = ConversationHandler(
+        name="meal",
+        persistent=True,
         entry_points=[CommandHandler("aggiungi_pasto", aggiungi_pasto_start)],
         states={
             MEAL_DAYS: [MessageHandler(filters.TEXT & ~filters.COMMAND, meal_days_received)],
@@ -1015,41 +3606,72 @@ def main():
             MEAL_RECIPE: [MessageHandler(filters.TEXT & ~filters.COMMAND, meal_recipe_received)],
             MEAL_REMINDER: [MessageHandler(filters.TEXT & ~filters.COMMAND, meal_reminder_received)],
             MEAL_REMINDER_CUSTOM: [MessageHandler(filters.TEXT & ~filters.COMMAND, meal_reminder_custom)],
+            ConversationHandler.TIMEOUT: [flow_timeout("meal")],
         },
-        fallbacks=[CommandHandler("annulla", cancel)],
+        fallbacks=[flow_cancel("meal")],
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
     # Conversation: Progressi
     progress_conv = ConversationHandler(
+        name="progress",
+        persistent=True,
         entry_points=[CommandHandler("progresso", progresso_start)],
         states={
             PROGRESS_WEIGHT: [MessageHandler(filters.TEXT, progress_weight)],
             PROGRESS_WAIST: [MessageHandler(filters.TEXT, progress_waist)],
             PROGRESS_HIPS: [MessageHandler(filters.TEXT, progress_hips)],
             PROGRESS_CHEST: [MessageHandler(filters.TEXT, progress_chest)],
+            ConversationHandler.TIMEOUT: [flow_timeout("progress")],
         },
-        fallbacks=[CommandHandler("annulla", cancel)],
+        fallbacks=[flow_cancel("progress")],
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
     # Conversation: Impostazioni
     settings_conv = ConversationHandler(
+        name="settings",
+        persistent=True,
         entry_points=[CommandHandler("impostazioni", impostazioni)],
         states={
             SETTINGS_DAY: [MessageHandler(filters.TEXT & ~filters.COMMAND, settings_day)],
             SETTINGS_GROCERY_TIME: [MessageHandler(filters.TEXT, settings_grocery_time)],
+            SETTINGS_TIMEZONE: [MessageHandler(filters.TEXT, settings_timezone)],
+            ConversationHandler.TIMEOUT: [flow_timeout("settings")],
+        },
+        fallbacks=[flow_cancel("settings")],
+        conversation_timeout=CONVERSATION_TIMEOUT,
+    )
+
+    # Conversation: Importa
+    import_conv = ConversationHandler(
+        name="import",
+        persistent=True,
+        entry_points=[CommandHandler("importa", importa)],
+        states={
+            IMPORT_FILE: [MessageHandler(filters.Document.ALL, import_file_received)],
+            ConversationHandler.TIMEOUT: [flow_timeout("import")],
         },
-        fallbacks=[CommandHandler("annulla", cancel)],
+        fallbacks=[flow_cancel("import")],
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
     # Conversation: Modifica Pasto
     edit_conv = ConversationHandler(
+        name="edit",
+        persistent=True,
         entry_points=[CommandHandler("modifica_pasto", modifica_pasto)],
         states={
-            EDIT_SELECT: [CallbackQueryHandler(edit_select, pattern=r"^edit_meal_")],
-            EDIT_FIELD: [CallbackQueryHandler(edit_field, pattern=r"^editfield_")],
+            EDIT_SELECT: [
+                CallbackQueryHandler(edit_select, pattern=r"^edit_meal_"),
+                CallbackQueryHandler(edit_page, pattern=r"^page_edit_\d+$"),
+            ],
+            EDIT_FIELD: [CallbackQueryHandler(edit_field, pattern=r"^editfield_\d+_")],
             EDIT_VALUE: [MessageHandler(filters.TEXT & ~filters.COMMAND, edit_value)],
+            ConversationHandler.TIMEOUT: [flow_timeout("edit")],
         },
-        fallbacks=[CommandHandler("annulla", cancel)],
+        fallbacks=[flow_cancel("edit")],
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
     # Handlers
@@ -1061,29 +3683,81 @@ def main():
     app.add_handler(progress_conv)
     app.add_handler(settings_conv)
     app.add_handler(edit_conv)
+    app.add_handler(import_conv)
     app.add_handler(CommandHandler("pasti", vedi_pasti))
     app.add_handler(CommandHandler("elimina_pasto", elimina_pasto))
     app.add_handler(CommandHandler("copia_pasto", copia_pasto))
+    app.add_handler(CommandHandler("copia_giorno", copia_giorno))
+    app.add_handler(CommandHandler("svuota_giorno", svuota_giorno))
+    app.add_handler(CommandHandler("scambia_giorni", scambia_giorni))
     app.add_handler(CallbackQueryHandler(elimina_pasto_callback, pattern=r"^del_meal_"))
+    app.add_handler(CallbackQueryHandler(plan_page, pattern=r"^page_(copy|del)_\d+$"))
     app.add_handler(CallbackQueryHandler(copia_pasto_select, pattern=r"^copy_meal_"))
-    app.add_handler(CallbackQueryHandler(copia_pasto_day, pattern=r"^copyday_"))
+    app.add_handler(CallbackQueryHandler(copia_pasto_day, pattern=r"^cpd_\d+_\d+$"))
+    app.add_handler(CallbackQueryHandler(copia_pasto_confirm, pattern=r"^cpok_\d+_\d+$"))
     app.add_handler(CommandHandler("storico", storico))
+    app.add_handler(CommandHandler("analisi", analisi))
+    app.add_handler(CommandHandler("grafico", grafico))
+    app.add_handler(CommandHandler("spesa", spesa))
+    app.add_handler(CommandHandler("esporta", esporta))
 
     # Job schedulati
     job_queue = app.job_queue
-    # Reminder pasti ogni 5 minuti (piu' preciso)
-    job_queue.run_repeating(send_meal_reminders, interval=300, first=10)
+    # Reminder pasti: ogni minuto legge solo le caselle scadute della timing wheel
+    job_queue.run_repeating(send_meal_reminders, interval=REMINDER_TICK_SECONDS, first=10)
+    # Lease degli shard e modifiche ai pasti fatte da altri processi
+    job_queue.run_repeating(shard_heartbeat, interval=SHARD_HEARTBEAT_SECONDS, first=SHARD_HEARTBEAT_SECONDS)
     # Reminder spesa ogni 5 minuti
-    job_queue.run_repeating(send_grocery_reminder, interval=300, first=30)
-    # Check-in settimanale alle 9:00
-    job_queue.run_daily(send_weekly_checkin, time=time(hour=9, minute=0))
-    # Messaggi motivazionali: alle 10:00 e alle 15:00
-    job_queue.run_daily(send_random_motivation, time=time(hour=10, minute=0))
-    job_queue.run_daily(send_random_motivation, time=time(hour=15, minute=0))
+    job_queue.run_repeating(send_grocery_reminder, interval=GROCERY_TICK_SECONDS, first=30)
+    # Pulizia notturna del registro dei reminder inviati
+    job_queue.run_daily(prune_sent_reminders, time=time(hour=3, minute=30))
+    # Check-in settimanale alle 9:00 e messaggi motivazionali alle 10:00 e alle 15:00, nel fuso di ogni utente
+    job_queue.run_repeating(send_weekly_checkin, interval=GROCERY_TICK_SECONDS, first=40)
+    job_queue.run_repeating(send_random_motivation, interval=GROCERY_TICK_SECONDS, first=50)
+    # user_data degli utenti inattivi fuori dalla memoria
+    job_queue.run_repeating(evict_user_data, interval=USER_DATA_EVICT_INTERVAL, first=USER_DATA_EVICT_INTERVAL)
+    # Metriche interne nel log
+    job_queue.run_repeating(log_metrics, interval=METRICS_LOG_INTERVAL, first=METRICS_LOG_INTERVAL)
+
+    logger.info(f"🥗 Diet Bot v2 avviato! (modalita' {BOT_MODE})")
+    run(app)
+
+
+async def run_cli(args):
+    try:
+        if args.command == "esporta":
+            count = await export_to_file(args.file, args.formato, args.utente)
+            print(f"{count} righe esportate in {args.file}")
+        else:
+            meals, progress = await import_from_file(args.file, args.formato, args.utente)
+            print(f"Importati {meals} pasti e {progress} rilevazioni da {args.file}")
+    finally:
+        await db.close()
+
+
+def cli(argv):
+    """python bot.py esporta|importa FILE: stesse funzioni di /esporta e /importa, per tutti gli utenti."""
+    parser = argparse.ArgumentParser(prog="bot.py", description="Esporta o importa pasti e progressi del bot.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (("esporta", "scrive pasti e progressi su file"), ("importa", "carica pasti e progressi da file")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument("file")
+        command.add_argument("--formato", choices=sorted(EXPORT_FORMATS), help="default: dall'estensione del file")
+        command.add_argument("--utente", type=int, help="solo questo utente (in importazione: assegna tutto a lui)")
+    args = parser.parse_args(argv)
+    args.formato = args.formato or export_format(args.file)
+    if args.formato is None:
+        parser.error("formato non riconosciuto: usa --formato o un file .csv/.json/.jsonl")
 
-    logger.info("🥗 Diet Bot v2 avviato!")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    init_db()
+    try:
+        asyncio.run(run_cli(args))
+    except (ValueError, csv.Error, sqlite3.IntegrityError) as e:
+        raise SystemExit(f"Importazione annullata: {e}")
 
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1:
+        cli(sys.argv[1:])
+    else:
+        main()